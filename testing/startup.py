@@ -4,13 +4,18 @@ This script starts the test suite from within QGIS.
 It should be mounted to ~/.local/share/QGIS/QGIS3/startup.py to run the tests on QGIS startup.
 """
 
+import os
 import sys
 
 from qgis.PyQt.QtCore import qDebug
 from qgis.utils import iface
 
 # TODO: proper tests discovery
-from travel_time_platform_plugin.tests import run_suite, system_info
+from travel_time_platform_plugin.tests import (
+    run_benchmark_suite,
+    run_suite,
+    system_info,
+)
 
 # Forward pyqgis output to console
 sys.stdout.write = lambda text: qDebug(text.encode("ascii", "replace").strip())
@@ -25,8 +30,11 @@ def run_tests():
     # Show output
     print(system_info())
 
-    # Run the tests
-    tests = run_suite(stream=sys.stdout)
+    # Run the tests (or the benchmarks if TEST_SUITE=benchmark)
+    if os.environ.get("TEST_SUITE") == "benchmark":
+        tests = run_benchmark_suite(stream=sys.stdout)
+    else:
+        tests = run_suite(stream=sys.stdout)
 
     # To workaround missing exit code (see below), so we print the result value and check for it in the runner
     if tests.wasSuccessful():
@@ -1,25 +1,23 @@
+import collections
 import json
 import math
 import os
 import random
+import threading
+import time
 
-from processing.gui.AlgorithmExecutor import execute_in_place
 from qgis.core import (
     NULL,
-    QgsApplication,
     QgsCategorizedSymbolRenderer,
     QgsCoordinateTransform,
     QgsExpression,
     QgsExpressionContext,
     QgsFeature,
-    QgsFeatureRequest,
-    QgsFeatureSink,
     QgsField,
     QgsFields,
     QgsGeometry,
     QgsLineString,
     QgsLineSymbol,
-    QgsPoint,
     QgsProcessing,
     QgsProcessingException,
     QgsProcessingParameterBoolean,
@@ -33,12 +31,12 @@ from qgis.core import (
     QgsRendererCategory,
     QgsWkbTypes,
 )
-from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtCore import QSettings, QVariant
 from qgis.PyQt.QtGui import QColor
 
-from .. import resources, utils
+from .. import cache, constants, resources, utils
 from ..utils import tr
-from .base import EPSG4326, ProcessingAlgorithmBase
+from .base import EPSG4326, ApiError, ProcessingAlgorithmBase
 
 # Constants to define behaviour of available properties
 PROPERTY_DEFAULT_NO = 0
@@ -58,6 +56,12 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
 
     available_properties = {}
 
+    # Maximum amount of departure (and of arrival) searches per request, as per the API limits
+    search_batch_maximum = 10
+
+    # Whether to keep the locations features indexed by id (in self.locations_features) to build the output
+    keep_locations_features = False
+
     def initAlgorithm(self, config):
         """Base setup of the algorithm.
 
@@ -286,7 +290,7 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
             ),
             advanced=True,
             help_text=tr(
-                "Ignore error instead of failing. This will consume your API quota much faster as searches won't be batched, and may yield incomplete results."
+                "Ignore errors instead of failing. Requests that fail are split to isolate the failing searches, which are skipped. This consumes a few more API calls for each failing search, and may yield incomplete results."
             ),
         )
 
@@ -297,41 +301,157 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
             )
         )
 
+    def doProcessAlgorithm(self, parameters, context, feedback):
+        # Configure common expressions inputs
+        with self.profiler.phase("configure parameters"):
+            self.processAlgorithmConfigureParams(parameters, context, feedback)
+
+        # Read the input layers once
+        with self.profiler.phase("prepare searches"):
+            self.processAlgorithmIndexData(parameters, context, feedback)
+
+        # Slice queries if needed (lazily, as the size of the slices adapts to the responses)
+        slices = self.processAlgorithmGetSlices(parameters, context, feedback)
+
+        # Make the query (in slices, several slices being sent concurrently). This is
+        # a generator, so results get written to the output as soon as they arrive.
+        slices_results = self._processAlgorithmYieldSlicesResults(
+            slices, parameters, context, feedback
+        )
+
+        # Configure output
+        return self.processAlgorithmOutput(
+            slices_results, parameters, context, feedback
+        )
+
+    def _processAlgorithmYieldSlicesResults(
+        self, slices, parameters, context, feedback
+    ):
+        """Yields the results of each slice, in order, as the responses arrive
+
+        The output flushes its sink once it wrote the results of a slice (see utils.flatten_marking_last).
+        """
+
+        # Slices whose requests were dispatched, in the same order as the responses
+        dispatched = collections.deque()
+        responses = self.processAlgorithmMakeRequests(
+            parameters,
+            context,
+            feedback,
+            self._processAlgorithmYieldSlicesData(
+                slices, dispatched, parameters, context, feedback
+            ),
+        )
+        progress = 0
+        try:
+            for response_data in responses:
+                slice_ = dispatched.popleft()
+                self.profiler.record("slices", time.monotonic() - slice_["dispatched"])
+                feedback.pushDebugInfo("Loading response to layer...")
+                yield response_data["results"]
+                progress += slice_["weight"]
+                feedback.setProgress(100 * progress)
+        finally:
+            # When closed early, stop the requests in flight (see processAlgorithmMakeRequests)
+            responses.close()
+
+    def _processAlgorithmYieldSlicesData(
+        self, slices, dispatched, parameters, context, feedback
+    ):
+        """Yields the request data for each slice
+
+        This is consumed by processAlgorithmMakeRequests as the requests get dispatched, so that data is
+        prepared in the main thread and only for the slices that are about to be sent.
+        """
+
+        for slice_ in slices:
+            slice_["dispatched"] = time.monotonic()
+            dispatched.append(slice_)
+            with self.profiler.phase("prepare slices"):
+                data = self.processAlgorithmSliceData(
+                    slice_, parameters, context, feedback
+                )
+            yield {"data": data, "slice_": slice_}
+
+    def processAlgorithmSliceData(self, slice_, parameters, context, feedback):
+        """Returns the request data for a slice"""
+
+        # Prepare the data
+        data = self.processAlgorithmPrepareSearchData(
+            slice_["search_slice_start"],
+            slice_["search_slice_end"],
+            parameters,
+            context,
+            feedback,
+        )
+
+        # Remix the data as needed
+        return self.processAlgorithmRemixDataFull(
+            data, slice_, parameters, context, feedback
+        )
+
     def processAlgorithmGetSlices(self, parameters, context, feedback):
-        """Gets the slices to subdivide queries in smaller chunks"""
-        slices = list(self._processAlgorithmYieldSlices(parameters, context, feedback))
+        """Gets the slices to subdivide queries in smaller chunks
+
+        Slices are yielded lazily, so that their size can adapt to the responses received so far.
+        """
+        self.search_batch = utils.BatchSizer(self.search_batch_maximum)
 
-        if len(slices) > 1:
+        slices_count = self.processAlgorithmMinimumSlicesCount()
+        if slices_count > 1:
             feedback.pushInfo(
                 tr(
-                    "Due to the large amount of features, the request will be chunked in {} API calls. This may have unexpected consequences on some parameters. Keep an eye on your API usage !"
-                ).format(len(slices))
+                    "Due to the large amount of features, the request will be chunked in at least {} API calls. This may have unexpected consequences on some parameters. Keep an eye on your API usage !"
+                ).format(slices_count)
             )
 
-        return slices
+        return self._processAlgorithmYieldSlices(parameters, context, feedback)
+
+    def processAlgorithmSearchCount(self):
+        """Returns the amount of departure or arrival searches (whichever is largest)"""
+        return max((len(searches) for searches in self.searches.values()), default=0)
+
+    def processAlgorithmMinimumSlicesCount(self):
+        """Returns the amount of slices if all are of the maximum size"""
+        return math.ceil(self.processAlgorithmSearchCount() / self.search_batch_maximum)
 
     def _processAlgorithmYieldSlices(self, parameters, context, feedback):
-        """Yields slices to subdivide queries in smaller chunks"""
+        """Yields slices to subdivide queries in smaller chunks
 
-        departure_count = (
-            self.params["INPUT_DEPARTURE_SEARCHES"].featureCount()
-            if self.params["INPUT_DEPARTURE_SEARCHES"]
-            else 0
-        )
-        arrival_count = (
-            self.params["INPUT_ARRIVAL_SEARCHES"].featureCount()
-            if self.params["INPUT_ARRIVAL_SEARCHES"]
-            else 0
-        )
+        Each slice has a weight, which is its share of the total work (used to report progress).
+        """
 
-        slicing_size = 1 if self.params["INPUT_ROBUST_MODE"] else 10
-        slicing_count = math.ceil(max(departure_count, arrival_count) / slicing_size)
+        search_count = self.processAlgorithmSearchCount()
 
-        for i in range(slicing_count):
+        start = 0
+        while start < search_count:
+            # Read the size for each slice, as it adapts to the responses
+            end = min(start + self.search_batch.size, search_count)
             yield {
-                "search_slice_start": i * slicing_size,
-                "search_slice_end": (i + 1) * slicing_size,
+                "search_slice_start": start,
+                "search_slice_end": end,
+                "weight": (end - start) / search_count,
             }
+            start = end
+
+    def _processAlgorithmBisectSlice(self, slice_):
+        """Splits a slice in two halves (searches first, then locations), or returns None if it can't be split"""
+
+        for key, count in [
+            ("search_slice", self.processAlgorithmSearchCount()),
+            ("loc_slice", len(getattr(self, "locations", []))),
+        ]:
+            if key + "_start" not in slice_:
+                continue
+            start = slice_[key + "_start"]
+            end = min(slice_[key + "_end"], count)
+            if end - start > 1:
+                middle = (start + end) // 2
+                return [
+                    {**slice_, key + "_end": middle},
+                    {**slice_, key + "_start": middle},
+                ]
+        return None
 
     def processAlgorithmRemixSearchDataInstance(
         self, DEPARR, search_data, parameters, context, feedback
@@ -339,34 +459,43 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
         """To be overriden by subclasses : allow to edit the search data object (row by row) before sending to the API"""
         return search_data
 
-    def processAlgorithmRemixDataFull(self, data, parameters, context, feedback):
+    def processAlgorithmRemixDataFull(
+        self, data, slice_, parameters, context, feedback
+    ):
         """To be overriden by subclasses : allow to edit the full data dictionnary before sending to the API"""
         return data
 
-    def processAlgorithmPrepareSearchData(
-        self, slicing_start, slicing_end, parameters, context, feedback
-    ):
-        """This method prepares the data array with all parameters corresponding to the common search attributes
+    def processAlgorithmIndexData(self, parameters, context, feedback):
+        """Reads the input layers once, preparing the data of every feature
 
-        The slicing_start/end params allow to prepare just a slice, to conform to API limitation (for now 10 searches/query)
+        This fills self.searches (the search data for each of departure/arrival) and, for algorithms
+        that have locations, self.locations. Slices are then taken from these lists, so that each feature
+        is read, reprojected and evaluated only once, whatever the number of slices.
+
+        For algorithms that keep existing fields, self.searches_attributes maps the id of each search
+        to the values of these fields, so that they can be joined back to the results.
         """
-        data = {}
+        self.searches = {}
+        self.searches_attributes = {}
         for DEPARR in ["DEPARTURE", "ARRIVAL"]:
             source = self.params["INPUT_" + DEPARR + "_SEARCHES"]
             deparr = DEPARR.lower()
             if source:
                 feedback.pushDebugInfo("Loading {} searches features...".format(deparr))
-                data[deparr + "_searches"] = []
+                self.searches[deparr] = []
+                self.searches_attributes[deparr] = {}
+                fields_to_keep = self.params.get(
+                    "INPUT_" + DEPARR + "_EXISTING_FIELDS_TO_KEEP"
+                )
                 xform = QgsCoordinateTransform(
                     source.sourceCrs(), EPSG4326, context.transformContext()
                 )
-                for i, feature in enumerate(source.getFeatures()):
+                for feature in source.getFeatures():
                     # Stop the algorithm if cancel button has been clicked
-                    # if feedback.isCanceled():
-                    #     break
-
-                    if i < slicing_start or i >= slicing_end:
-                        continue
+                    if feedback.isCanceled():
+                        raise QgsProcessingException(
+                            "Algorithm was cancelled by the user."
+                        )
 
                     # Set feature for expression context
                     self.expressions_context.setFeature(feature)
@@ -417,14 +546,62 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
                             ]
                         search_data.update({"range": range_data_dict})
 
+                    if fields_to_keep:
+                        # Keep the first feature if ids are not unique
+                        self.searches_attributes[deparr].setdefault(
+                            str(search_data["id"]),
+                            [feature.attribute(name) for name in fields_to_keep],
+                        )
+
                     search_data = self.processAlgorithmRemixSearchDataInstance(
                         DEPARR, search_data, parameters, context, feedback
                     )
 
-                    data[deparr + "_searches"].append(search_data)
+                    self.searches[deparr].append(search_data)
 
-                    # # Update the progress bar
-                    # feedback.setProgress(int(current * total))
+        self.locations = []
+        self.locations_features = {}
+        if self.has_param("INPUT_LOCATIONS"):
+            feedback.pushDebugInfo("Loading locations features...")
+            locations = self.params["INPUT_LOCATIONS"]
+            xform = QgsCoordinateTransform(
+                locations.sourceCrs(), EPSG4326, context.transformContext()
+            )
+            for feature in locations.getFeatures():
+                if feedback.isCanceled():
+                    raise QgsProcessingException("Algorithm was cancelled by the user.")
+
+                # Set feature for expression context
+                self.expressions_context.setFeature(feature)
+                geometry = feature.geometry()
+                geometry.transform(xform)
+                location_id = self.eval_expr("INPUT_LOCATIONS_ID")
+                self.locations.append(
+                    {
+                        "id": location_id,
+                        "coords": {
+                            "lat": geometry.asPoint().y(),
+                            "lng": geometry.asPoint().x(),
+                        },
+                    }
+                )
+                if self.keep_locations_features:
+                    # Keep the first feature if ids are not unique
+                    self.locations_features.setdefault(str(location_id), feature)
+
+    def processAlgorithmPrepareSearchData(
+        self, slicing_start, slicing_end, parameters, context, feedback
+    ):
+        """This method prepares the data array with all parameters corresponding to the common search attributes
+
+        The slicing_start/end params allow to prepare just a slice, to conform to API limitation (for now 10 searches/query)
+        """
+        data = {}
+        for deparr, searches in self.searches.items():
+            # Searches are copied, as they may be remixed before being sent
+            data[deparr + "_searches"] = [
+                dict(search) for search in searches[slicing_start:slicing_end]
+            ]
         return data
 
     def processAlgorithmComputeSearchCountForThrottling(self, data):
@@ -433,10 +610,24 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
             data.get("arrival_searches", [])
         )
 
+    def processAlgorithmResponseReceived(self, data, response, duration):
+        """Adapts the size of the next slices"""
+
+        if response.from_cache:
+            return
+        count = max(
+            len(data.get("departure_searches", [])),
+            len(data.get("arrival_searches", [])),
+        )
+        self.search_batch.record(count, duration, len(response.content))
+
     def processAlgorithmMakeRequest(
-        self, parameters, context, feedback, data=None, params={}
+        self, parameters, context, feedback, data=None, params={}, slice_=None
     ):
-        """Calls AlgorithmBase.processAlgorithmMakeRequest but optionally catching exception"""
+        """Calls AlgorithmBase.processAlgorithmMakeRequest but optionally catching exception
+
+        In robust mode, a failing slice is split in halves which are retried, so that only
+        the failing searches get ignored."""
 
         try:
             return super().processAlgorithmMakeRequest(
@@ -444,12 +635,43 @@ class _SearchAlgorithmBase(ProcessingAlgorithmBase):
             )
         except QgsProcessingException as e:
             if self.params["INPUT_ROBUST_MODE"]:
-                feedback.reportError(
+                halves = None
+                # Only errors caused by the searches themselves can be isolated
+                if (
+                    isinstance(e, ApiError)
+                    and e.is_request_error()
+                    and slice_ is not None
+                    and not feedback.isCanceled()
+                ):
+                    halves = self._processAlgorithmBisectSlice(slice_)
+                if halves is None:
+                    searches_ids = [
+                        search["id"]
+                        for deparr in ["departure", "arrival"]
+                        for search in data.get(deparr + "_searches", [])
+                    ]
+                    feedback.reportError(
+                        tr(
+                            "An API error was ignored due to robust mode (searches {}). You will likely get incomplete result."
+                        ).format(", ".join(str(id_) for id_ in searches_ids))
+                    )
+                    return {"results": []}
+
+                feedback.pushInfo(
                     tr(
-                        "An API error was ignored due to robust mode. You will likely get incomplete result."
+                        "Splitting the failed request to isolate the failing searches..."
                     )
                 )
-                return {"results": []}
+                results = []
+                for half in halves:
+                    half_data = self.processAlgorithmSliceData(
+                        half, parameters, context, feedback
+                    )
+                    response_data = self.processAlgorithmMakeRequest(
+                        parameters, context, feedback, half_data, params, half
+                    )
+                    results.extend(response_data["results"])
+                return {"results": results}
             else:
                 feedback.reportError(
                     tr(
@@ -471,6 +693,9 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
     url = "/v4/time-map"
     accept_header = "application/vnd.wkt+json"
     available_properties = {"is_only_walking": PROPERTY_DEFAULT_YES}
+    # Results are cached per search instead (see processAlgorithmIndexData), storing whole responses too
+    # would double the disk usage
+    cache_responses = False
     output_type = QgsProcessing.TypeVectorPolygon
 
     _name = "time_map"
@@ -485,6 +710,9 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
 
     RESULT_TYPE = ["NORMAL", "UNION", "INTERSECTION"]
 
+    # Amount of shapes that are unioned at once when aggregating with UNION
+    union_chunk_size = 64
+
     def initAlgorithm(self, config):
         # Define all common DEPARTURE and ARRIVAL parameters
         super().initAlgorithm(config)
@@ -566,7 +794,7 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
                 defaultValue=True,
             ),
             help_text=tr(
-                "Whether to fix invalid geometries in the post-processing step. Most of time, this should be enabled."
+                "Whether to fix invalid geometries as they are received. Most of time, this should be enabled."
             ),
         )
 
@@ -593,41 +821,100 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
 
         return data
 
-    def doProcessAlgorithm(self, parameters, context, feedback):
-        # Configure common expressions inputs
-        self.processAlgorithmConfigureParams(parameters, context, feedback)
-
-        # Slice queries if needed
-        slices = self.processAlgorithmGetSlices(parameters, context, feedback)
-
-        # Make the query (in slices)
-        results = []
-        for slice_ in slices:
-            slc_start = slice_["search_slice_start"]
-            slc_end = slice_["search_slice_end"]
+    def processAlgorithmIndexData(self, parameters, context, feedback):
+        """Looks up each search in the searches cache, only keeping the ones that must be requested
 
-            # Prepare the data
-            data = self.processAlgorithmPrepareSearchData(
-                slc_start, slc_end, parameters, context, feedback
-            )
-
-            # Remix the data as needed
-            data = self.processAlgorithmRemixDataFull(
-                data, parameters, context, feedback
+        Searches are cached individually (and not just as part of the whole request), so that a rerun
+        with some new searches only sends the new ones, no matter how they end up being batched.
+        """
+        super().processAlgorithmIndexData(parameters, context, feedback)
+
+        # The host is part of the key, so that results from another endpoint (e.g. a mock server) are not reused
+        endpoint = (
+            QSettings().value(
+                "traveltime_platform/custom_endpoint",
+                constants.DEFAULT_ENDPOINT,
+                type=str,
             )
+            + self.url
+            + " "
+            + self.accept_header
+        )
+        # Only the keys of the cached searches are kept, their results are read as they are output
+        self.cached_searches = []
+        self.searches_cache_keys = {}
+        for deparr, searches in self.searches.items():
+            searches_to_request = []
+            for search in searches:
+                key = cache.instance.search_key(endpoint, search)
+                if cache.instance.has_search(key):
+                    self.cached_searches.append((search["id"], key))
+                else:
+                    # Ids are compared as strings, as they come back as strings from the API
+                    self.searches_cache_keys[str(search["id"])] = key
+                    searches_to_request.append(search)
+            self.searches[deparr] = searches_to_request
 
-            response_data = self.processAlgorithmMakeRequest(
-                parameters, context, feedback, data=data
+        if self.cached_searches:
+            feedback.pushInfo(
+                tr(
+                    "{} searches were found in the cache, {} searches will be requested."
+                ).format(len(self.cached_searches), len(self.searches_cache_keys))
             )
 
-            results += response_data["results"]
-
-        feedback.pushDebugInfo("Loading response to layer...")
+    def _processAlgorithmYieldSlicesResults(
+        self, slices, parameters, context, feedback
+    ):
+        """Yields the cached results (as a first slice), then the requested ones (saving them to the searches cache)"""
 
-        # Configure output
-        return self.processAlgorithmOutput(results, parameters, context, feedback)
+        if self.cached_searches:
+            yield self._processAlgorithmYieldCachedResults(feedback)
 
-    def processAlgorithmOutput(self, results, parameters, context, feedback):
+        slices_results = super()._processAlgorithmYieldSlicesResults(
+            slices, parameters, context, feedback
+        )
+        try:
+            for results in slices_results:
+                for result in results:
+                    key = self.searches_cache_keys.get(str(result["search_id"]))
+                    if key is not None:
+                        cache.instance.save_search(key, result)
+                yield results
+        finally:
+            slices_results.close()
+
+    def _processAlgorithmYieldCachedResults(self, feedback):
+        """Yields the cached results, read one at a time"""
+
+        for search_id, key in self.cached_searches:
+            result, size = cache.instance.get_search(key)
+            if result is None:
+                # The entry was evicted (e.g. by another run) since the searches were indexed
+                feedback.reportError(
+                    tr(
+                        "The cached result of search {} is not available anymore. Run the algorithm again to request it."
+                    ).format(search_id)
+                )
+                continue
+            cache.instance.record(True, size)
+            yield {**result, "search_id": search_id}
+
+    def processAlgorithmShapeGeometry(self, shape):
+        """Returns the geometry of a shape (runs in a worker thread)"""
+        return self.processAlgorithmRepairGeometry(QgsGeometry.fromWkt(shape))
+
+    def processAlgorithmRepairGeometry(self, geom):
+        """Returns the geometry, repaired if it is invalid and fixing geometries is enabled"""
+        if not self.params["OUTPUT_FIX_GEOMETRIES"] or geom.isGeosValid():
+            return geom
+        geom = geom.makeValid()
+        # Repairing may produce lines or points along the polygons, which are dropped
+        geom.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+        with self.repaired_lock:
+            self.repaired_count += 1
+        return geom
+
+    def processAlgorithmOutput(self, slices_results, parameters, context, feedback):
         output_fields = QgsFields()
 
         output_fields.append(QgsField("id", QVariant.String, "text"))
@@ -648,19 +935,34 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
                 new_field.setName("original_" + deparr + "_" + old_field.name())
                 output_fields.append(new_field)
 
-        (sink, sink_id) = self.parameterAsSink(
+        (sink, sink_id) = self.processAlgorithmOutputSink(
             parameters,
             "OUTPUT",
             context,
             output_fields,
             QgsWkbTypes.MultiPolygon,
             EPSG4326,
+            feedback,
         )
 
         result_type = self.RESULT_TYPE[self.params["OUTPUT_RESULT_TYPE"]]
 
+        # Shapes are parsed (and repaired if needed) in a thread pool while the results stream in
+        shapes = utils.ordered_map(
+            lambda item: (
+                *item,
+                self.processAlgorithmShapeGeometry(item[0]["shape"]),
+            ),
+            utils.flatten_marking_last(slices_results),
+        )
+        self.repaired_count = 0
+        self.repaired_lock = threading.Lock()
+
         aggregate_geom = None
-        for result in results:
+        # For unions, shapes are unioned by chunks, then the chunks are unioned together (cascaded union)
+        union_shapes = []
+        union_chunks = []
+        for result, last_of_slice, geom in shapes:
             if result_type == "NORMAL":
                 feature = QgsFeature(output_fields)
                 feature.setAttribute("id", result["search_id"])
@@ -668,72 +970,87 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
                     feature.setAttribute(
                         "prop_" + prop, result["properties"].get(prop, NULL)
                     )
-                feature.setGeometry(QgsGeometry.fromWkt(result["shape"]))
+                feature.setGeometry(geom)
 
-                # dirty section where we join back columns from the input layer
+                # join back columns from the input layer (indexed by search id when reading the searches)
                 for deparr in ["departure", "arrival"]:
                     DEPARR = deparr.upper()
-                    input_layer = self.params["INPUT_" + DEPARR + "_SEARCHES"]
-                    if (
-                        input_layer
-                        and self.params["INPUT_" + DEPARR + "_EXISTING_FIELDS_TO_KEEP"]
-                    ):
-                        expr = QgsExpression(
-                            "{expr} = '{id}'".format(
-                                expr=self.params[
-                                    "INPUT_" + DEPARR + "_ID"
-                                ].expression(),
-                                id=result["search_id"],
-                            )
+                    fields_to_keep = self.params[
+                        "INPUT_" + DEPARR + "_EXISTING_FIELDS_TO_KEEP"
+                    ]
+                    if deparr in self.searches_attributes and fields_to_keep:
+                        values = self.searches_attributes[deparr].get(
+                            str(result["search_id"])
                         )
-
-                        # this should return an iterator with only one feature
-                        existing_features = input_layer.getFeatures(
-                            QgsFeatureRequest(expr)
-                        )
-                        try:
-                            existing_feature = existing_features.__next__()
-                            for field_name in self.params[
-                                "INPUT_" + DEPARR + "_EXISTING_FIELDS_TO_KEEP"
-                            ]:
+                        if values is not None:
+                            for field_name, value in zip(fields_to_keep, values):
                                 feature.setAttribute(
-                                    "original_" + deparr + "_" + field_name,
-                                    existing_feature.attribute(field_name),
+                                    "original_" + deparr + "_" + field_name, value
                                 )
                             break
-                        except StopIteration:
-                            feedback.reportError(
-                                "Couldn't find source feature for result {} (using following expression : {}).".format(
-                                    result["search_id"], expr.expression()
-                                )
+                        feedback.reportError(
+                            "Couldn't find source feature for result {} (using following expression : {}).".format(
+                                result["search_id"],
+                                self.params["INPUT_" + DEPARR + "_ID"].expression(),
                             )
+                        )
 
                 # Add a feature in the sink
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
-            else:
-                # Build the aggregated feature
-                geom = QgsGeometry.fromWkt(result["shape"])
-
+                sink.addFeature(feature)
+            elif result_type == "UNION":
+                union_shapes.append(geom)
+                if len(union_shapes) >= self.union_chunk_size:
+                    union_chunks.append(QgsGeometry.unaryUnion(union_shapes))
+                    union_shapes = []
+            elif result_type == "INTERSECTION":
                 if aggregate_geom is None:
                     aggregate_geom = geom
+                elif aggregate_geom.boundingBox().intersects(geom.boundingBox()):
+                    aggregate_geom = aggregate_geom.intersection(geom)
                 else:
-                    if result_type == "UNION":
-                        aggregate_geom = aggregate_geom.combine(geom)
-                    elif result_type == "INTERSECTION":
-                        aggregate_geom = aggregate_geom.intersection(geom)
-                    else:
-                        raise Exception("Unsupported aggregation operator")
-                    # If we got a geometry collection (probaby because of polygons just touching creating points or lines)
-                    # we filter them out and only keep polygons
-                    aggregate_geom.convertGeometryCollectionToSubclass(
-                        QgsWkbTypes.PolygonGeometry
+                    aggregate_geom = QgsGeometry()
+
+                # Once empty, the intersection will stay empty, so there's no need to go on
+                if aggregate_geom.isEmpty():
+                    feedback.pushInfo(
+                        tr(
+                            "The intersection is empty, the remaining searches are skipped."
+                        )
                     )
+                    # Stop parsing shapes and the requests in flight, rather than waiting for them
+                    shapes.close()
+                    slices_results.close()
+                    break
+            else:
+                raise Exception("Unsupported aggregation operator")
+
+            # Write the features of the slice before waiting for the next response
+            if last_of_slice:
+                sink.flush()
+
+        if result_type == "UNION":
+            aggregate_geom = QgsGeometry.unaryUnion(union_chunks + union_shapes)
+
+        if aggregate_geom is not None and not aggregate_geom.isEmpty():
+            # If we got a geometry collection (probaby because of polygons just touching creating points or lines)
+            # we filter them out and only keep polygons
+            aggregate_geom.convertGeometryCollectionToSubclass(
+                QgsWkbTypes.PolygonGeometry
+            )
+            aggregate_geom = self.processAlgorithmRepairGeometry(aggregate_geom)
+
+        if self.repaired_count:
+            feedback.pushInfo(
+                tr("{} invalid geometries were fixed.").format(self.repaired_count)
+            )
 
         if result_type != "NORMAL":
             feature = QgsFeature(output_fields)
             feature.setAttribute("id", result_type)
             feature.setGeometry(aggregate_geom)
-            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            sink.addFeature(feature)
+
+        sink.finish()
 
         feedback.pushDebugInfo("TimeMapAlgorithm done !")
 
@@ -745,16 +1062,6 @@ class TimeMapAlgorithm(_SearchAlgorithmBase):
     def postProcessAlgorithm(self, context, feedback):
         output_layer = QgsProcessingUtils.mapLayerFromString(self.sink_id, context)
 
-        # Run fix geometries in place
-        if self.params["OUTPUT_FIX_GEOMETRIES"]:
-            feedback.pushDebugInfo("Running fixgeometries")
-            registry = QgsApplication.instance().processingRegistry()
-            params = {"INPUT": output_layer}
-            execute_in_place(registry.algorithmById("native:fixgeometries"), params)
-            output_layer.removeSelection()
-            if output_layer.isEditable():
-                output_layer.commitChanges()
-
         # Load style
         result_type = self.RESULT_TYPE[self.params["OUTPUT_RESULT_TYPE"]]
         if result_type == "NORMAL":
@@ -793,6 +1100,11 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
         "This algorithms allows to use the time-filter endpoint from the TravelTime API.\n\nIt matches the endpoint data structure as closely as possible. The key difference with the API is that the filter is automatically done on ALL locations, while the API technically allows to specify which locations to filter for each search.\n\nPlease see the help on {url} for more details on how to use it.\n\nConsider using the simplified algorithms as they may be easier to work with."
     ).format(url=_helpUrl)
 
+    # Maximum amount of locations per request, as per the API limits
+    locations_batch_size = 2000
+
+    keep_locations_features = True
+
     def initAlgorithm(self, config):
         # Define all common DEPARTURE and ARRIVAL parameters
         super().initAlgorithm(config)
@@ -822,72 +1134,13 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
             ),
         )
 
-    def doProcessAlgorithm(self, parameters, context, feedback):
-        # Configure common expressions inputs
-        self.processAlgorithmConfigureParams(parameters, context, feedback)
-
-        # Slice queries if needed
-        slices = self.processAlgorithmGetSlices(parameters, context, feedback)
-
-        # Make the query (in slices)
-        results = []
-        for slice_ in slices:
-            slc_start = slice_["search_slice_start"]
-            slc_end = slice_["search_slice_end"]
-
-            # Prepare the data
-            data = self.processAlgorithmPrepareSearchData(
-                slc_start, slc_end, parameters, context, feedback
-            )
-
-            # Remix the data as needed
-            data = self.processAlgorithmRemixDataFull(
-                data, slice_, parameters, context, feedback
-            )
-
-            # Make the query
-            response_data = self.processAlgorithmMakeRequest(
-                parameters, context, feedback, data=data
-            )
-
-            results += response_data["results"]
-
-        feedback.pushDebugInfo("Loading response to layer...")
-
-        # Configure output
-        return self.processAlgorithmOutput(results, parameters, context, feedback)
-
     def processAlgorithmRemixDataFull(
         self, data, slice_, parameters, context, feedback
     ):
-        locations = self.params["INPUT_LOCATIONS"]
-
-        # Prepare location data (this is the same for all the slices)
-        data["locations"] = []
-        xform = QgsCoordinateTransform(
-            locations.sourceCrs(), EPSG4326, context.transformContext()
-        )
-
+        # Prepare location data
         slc_start = slice_["loc_slice_start"]
         slc_end = slice_["loc_slice_end"]
-
-        for i, feature in enumerate(locations.getFeatures()):
-            if i < slc_start or i >= slc_end:
-                continue
-
-            # Set feature for expression context
-            self.expressions_context.setFeature(feature)
-            geometry = feature.geometry()
-            geometry.transform(xform)
-            data["locations"].append(
-                {
-                    "id": self.eval_expr("INPUT_LOCATIONS_ID"),
-                    "coords": {
-                        "lat": geometry.asPoint().y(),
-                        "lng": geometry.asPoint().x(),
-                    },
-                }
-            )
+        data["locations"] = self.locations[slc_start:slc_end]
 
         # Currently, the API requires all geoms to be passed in the locations parameter
         # and refers to them using departure_location_id and arrival_location_ids in the
@@ -913,7 +1166,7 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
 
         return data
 
-    def processAlgorithmOutput(self, results, parameters, context, feedback):
+    def processAlgorithmOutput(self, slices_results, parameters, context, feedback):
         locations = self.params["INPUT_LOCATIONS"]
 
         output_fields = QgsFields(locations.fields())
@@ -926,35 +1179,57 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
         output_crs = locations.sourceCrs()
         output_type = locations.wkbType()
 
-        (sink, sink_id) = self.parameterAsSink(
-            parameters, "OUTPUT", context, output_fields, output_type, output_crs
+        (sink, sink_id) = self.processAlgorithmOutputSink(
+            parameters,
+            "OUTPUT",
+            context,
+            output_fields,
+            output_type,
+            output_crs,
+            feedback,
         )
 
-        def clone_feature(id_):
-            """Returns a feature cloned from the locations layer"""
-            id_expr = self.parameterAsString(parameters, "INPUT_LOCATIONS_ID", context)
-            expression_ctx = self.createExpressionContext(parameters, context)
-            expression = QgsExpression("{} = '{}'".format(id_expr, id_))
-            return utils.clone_feature(
-                QgsFeatureRequest(expression, expression_ctx), locations, output_fields
-            )
+        enabled_properties = self.enabled_properties()
+        no_properties = [NULL] * len(enabled_properties)
+
+        def clone_feature(id_, attributes):
+            """Returns a feature cloned from the indexed locations features, with the given attributes appended"""
+            source = self.locations_features.get(str(id_))
+            if source is None:
+                feedback.reportError(
+                    tr("Couldn't find source feature for location {}.").format(id_)
+                )
+                return None
+            feature = QgsFeature(output_fields)
+            feature.setGeometry(source.geometry())
+            feature.setAttributes(source.attributes() + attributes)
+            return feature
 
-        for result in results:
+        for result, last_of_slice in utils.flatten_marking_last(slices_results):
+            features = []
             for location in result["locations"]:
                 for properties in location["properties"]:
-                    feature = clone_feature(location["id"])
-                    feature.setAttribute("search_id", result["search_id"])
-                    feature.setAttribute("reachable", 1)
-                    for prop in self.enabled_properties():
-                        feature.setAttribute(
-                            "prop_" + prop, json.dumps(properties[prop])
+                    features.append(
+                        clone_feature(
+                            location["id"],
+                            [result["search_id"], 1]
+                            + [
+                                json.dumps(properties[prop])
+                                for prop in enabled_properties
+                            ],
                         )
-                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                    )
             for id_ in result["unreachable"]:
-                feature = clone_feature(id_)
-                feature.setAttribute("search_id", result["search_id"])
-                feature.setAttribute("reachable", 0)
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                features.append(
+                    clone_feature(id_, [result["search_id"], 0] + no_properties)
+                )
+            sink.addFeatures([f for f in features if f is not None])
+
+            # Write the features of the slice before waiting for the next response
+            if last_of_slice:
+                sink.flush()
+
+        sink.finish()
 
         feedback.pushDebugInfo("TimeFilterAlgorithm done !")
 
@@ -971,13 +1246,17 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
         )
         return super().postProcessAlgorithm(context, feedback)
 
+    def processAlgorithmMinimumSlicesCount(self):
+        locations_slices_count = math.ceil(
+            len(self.locations) / self.locations_batch_size
+        )
+        return super().processAlgorithmMinimumSlicesCount() * locations_slices_count
+
     def _processAlgorithmYieldSlices(self, parameters, context, feedback):
         """Yields slices to subdivide queries in smaller chunks"""
 
-        locations_count = self.params["INPUT_LOCATIONS"].featureCount()
-
-        slicing_size = 2000
-        slicing_count = math.ceil(locations_count / slicing_size)
+        slicing_size = self.locations_batch_size
+        slicing_count = math.ceil(len(self.locations) / slicing_size)
 
         for i in range(slicing_count):
             for slice_ in super()._processAlgorithmYieldSlices(
@@ -987,6 +1266,7 @@ class TimeFilterAlgorithm(_SearchAlgorithmBase):
                     {
                         "loc_slice_start": i * slicing_size,
                         "loc_slice_end": (i + 1) * slicing_size,
+                        "weight": slice_["weight"] / slicing_count,
                     }
                 )
                 yield slice_
@@ -1016,6 +1296,9 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
 
     RESULT_TYPE = ["BY_ROUTE", "BY_DURATION", "BY_TYPE"]
 
+    # Maximum amount of locations per request
+    locations_batch_size = 2
+
     def initAlgorithm(self, config):
         # Define all common DEPARTURE and ARRIVAL parameters
         super().initAlgorithm(config)
@@ -1062,72 +1345,13 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
             ),
         )
 
-    def doProcessAlgorithm(self, parameters, context, feedback):
-        # Configure common expressions inputs
-        self.processAlgorithmConfigureParams(parameters, context, feedback)
-
-        # Slice queries if needed
-        slices = self.processAlgorithmGetSlices(parameters, context, feedback)
-
-        # Make the query (in slices)
-        results = []
-        for slice_ in slices:
-            slc_start = slice_["search_slice_start"]
-            slc_end = slice_["search_slice_end"]
-
-            # Prepare the data
-            data = self.processAlgorithmPrepareSearchData(
-                slc_start, slc_end, parameters, context, feedback
-            )
-
-            # Remix the data as needed
-            data = self.processAlgorithmRemixDataFull(
-                data, slice_, parameters, context, feedback
-            )
-
-            # Make the query
-            response_data = self.processAlgorithmMakeRequest(
-                parameters, context, feedback, data=data
-            )
-
-            results += response_data["results"]
-
-        feedback.pushDebugInfo("Loading response to layer...")
-
-        # Configure output
-        return self.processAlgorithmOutput(results, parameters, context, feedback)
-
     def processAlgorithmRemixDataFull(
         self, data, slice_, parameters, context, feedback
     ):
-        locations = self.params["INPUT_LOCATIONS"]
-
         # Prepare location data
-        data["locations"] = []
-        xform = QgsCoordinateTransform(
-            locations.sourceCrs(), EPSG4326, context.transformContext()
-        )
-
         slc_start = slice_["loc_slice_start"]
         slc_end = slice_["loc_slice_end"]
-
-        for i, feature in enumerate(locations.getFeatures()):
-            if i < slc_start or i >= slc_end:
-                continue
-
-            # Set feature for expression context
-            self.expressions_context.setFeature(feature)
-            geometry = feature.geometry()
-            geometry.transform(xform)
-            data["locations"].append(
-                {
-                    "id": self.eval_expr("INPUT_LOCATIONS_ID"),
-                    "coords": {
-                        "lat": geometry.asPoint().y(),
-                        "lng": geometry.asPoint().x(),
-                    },
-                }
-            )
+        data["locations"] = self.locations[slc_start:slc_end]
 
         # Currently, the API requires all geoms to be passed in the locations parameter
         # and refers to them using departure_location_id and arrival_location_ids in the
@@ -1155,7 +1379,14 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
 
         return data
 
-    def processAlgorithmOutput(self, results, parameters, context, feedback):
+    def processAlgorithmLineString(self, coords):
+        """Returns a linestring built at once from a list of (x, y) tuples"""
+        if not coords:
+            return QgsLineString()
+        xs, ys = zip(*coords)
+        return QgsLineString(list(xs), list(ys))
+
+    def processAlgorithmOutput(self, slices_results, parameters, context, feedback):
         output_fields = QgsFields()
         result_type = self.RESULT_TYPE[self.params["OUTPUT_RESULT_TYPE"]]
         output_fields.append(QgsField("search_id", QVariant.String, "text"))
@@ -1175,21 +1406,32 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
         output_crs = EPSG4326
         output_type = QgsWkbTypes.LineString
 
-        (sink, sink_id) = self.parameterAsSink(
-            parameters, "OUTPUT", context, output_fields, output_type, output_crs
+        (sink, sink_id) = self.processAlgorithmOutputSink(
+            parameters,
+            "OUTPUT",
+            context,
+            output_fields,
+            output_type,
+            output_crs,
+            feedback,
         )
 
-        for result in results:
+        for result, last_of_slice in utils.flatten_marking_last(slices_results):
             for location in result["locations"]:
                 for properties in location["properties"]:
                     if result_type == "BY_ROUTE" or result_type == "BY_DURATION":
-                        # Create the geom
-                        geom = QgsLineString()
-                        for part in properties["route"]["parts"]:
-                            for coord in part["coords"]:
-                                point = QgsPoint(coord["lng"], coord["lat"])
-                                if geom.endPoint() != point:
-                                    geom.addVertex(point)
+                        # Create the geom (from all parts, without consecutive duplicate points)
+                        coords = [
+                            (coord["lng"], coord["lat"])
+                            for part in properties["route"]["parts"]
+                            for coord in part["coords"]
+                        ]
+                        coords = [
+                            coord
+                            for i, coord in enumerate(coords)
+                            if i == 0 or coord != coords[i - 1]
+                        ]
+                        geom = self.processAlgorithmLineString(coords)
 
                         # Create the feature
                         feature = QgsFeature(output_fields)
@@ -1202,14 +1444,16 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
                                 "prop_" + prop, json.dumps(properties[prop])
                             )
 
-                        sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                        sink.addFeature(feature)
                     else:
                         for part in properties["route"]["parts"]:
                             # Create the geom
-                            geom = QgsLineString()
-                            for coord in part["coords"]:
-                                point = QgsPoint(coord["lng"], coord["lat"])
-                                geom.addVertex(point)
+                            geom = self.processAlgorithmLineString(
+                                [
+                                    (coord["lng"], coord["lat"])
+                                    for coord in part["coords"]
+                                ]
+                            )
 
                             # Create the feature
                             feature_d = QgsFeature(output_fields)
@@ -1229,7 +1473,13 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
                                 "part_travel_time", part["travel_time"]
                             )
 
-                            sink.addFeature(feature_d, QgsFeatureSink.FastInsert)
+                            sink.addFeature(feature_d)
+
+            # Write the features of the slice before waiting for the next response
+            if last_of_slice:
+                sink.flush()
+
+        sink.finish()
 
         feedback.pushDebugInfo("TimeFilterAlgorithm done !")
 
@@ -1274,13 +1524,17 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
             layer.loadNamedStyle(style_path)
         return super().postProcessAlgorithm(context, feedback)
 
+    def processAlgorithmMinimumSlicesCount(self):
+        locations_slices_count = math.ceil(
+            len(self.locations) / self.locations_batch_size
+        )
+        return super().processAlgorithmMinimumSlicesCount() * locations_slices_count
+
     def _processAlgorithmYieldSlices(self, parameters, context, feedback):
         """Yields slices to subdivide queries in smaller chunks"""
 
-        locations_count = self.params["INPUT_LOCATIONS"].featureCount()
-
-        slicing_size = 2
-        slicing_count = math.ceil(locations_count / slicing_size)
+        slicing_size = self.locations_batch_size
+        slicing_count = math.ceil(len(self.locations) / slicing_size)
 
         for i in range(slicing_count):
             for slice_ in super()._processAlgorithmYieldSlices(
@@ -1290,6 +1544,7 @@ class RoutesAlgorithm(_SearchAlgorithmBase):
                     {
                         "loc_slice_start": i * slicing_size,
                         "loc_slice_end": (i + 1) * slicing_size,
+                        "weight": slice_["weight"] / slicing_count,
                     }
                 )
                 yield slice_
@@ -1,6 +1,8 @@
 import collections
-import datetime
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from qgis.core import (
@@ -9,6 +11,7 @@ from qgis.core import (
     QgsCoordinateTransform,
     QgsExpression,
     QgsExpressionContext,
+    QgsExpressionNode,
     QgsLayerMetadata,
     QgsMapLayer,
     QgsProcessingAlgorithm,
@@ -19,20 +22,52 @@ from qgis.core import (
     QgsProcessingParameterNumber,
     QgsProcessingUtils,
 )
-from qgis.PyQt.QtCore import QSettings
-from qgis.PyQt.QtTest import QTest
+from qgis.PyQt.QtCore import (
+    QCoreApplication,
+    QEventLoop,
+    QSettings,
+    Qt,
+    QThread,
+    QTimer,
+)
 from qgis.utils import iface
 
 from .. import auth, cache, constants
 from ..libraries import iso3166
 from ..ui import AlgorithmDialogWithSkipLogic
-from ..utils import log, throttler, tr
+from ..utils import (
+    BufferedSink,
+    Profiler,
+    SerializedFeedback,
+    log,
+    rate_controller,
+    throttler,
+    tr,
+)
 
 EPSG4326 = QgsCoordinateReferenceSystem("EPSG:4326")
 THROTTLING_PER_SETTINGS = "PER_SETTINGS"
 THROTTLING_DISABLED = "DISABLED"
 THROTTLING_STRATEGIES = [THROTTLING_PER_SETTINGS, THROTTLING_DISABLED]
 COUNTRIES = [(None, "-")] + list([(c.alpha2, c.name) for c in iso3166.countries])
+# Responses that are retried (after waiting), as they mean the API is overloaded
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+
+# Guards the queries counter, as requests may be made from several threads
+_count_lock = threading.Lock()
+
+
+class ApiError(QgsProcessingException):
+    """Raised when the API answered with an error status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def is_request_error(self):
+        """Whether the error is caused by the content of the request (rather than by authentication, quotas or the server)"""
+        return 400 <= self.status_code < 500 and self.status_code not in (401, 403, 429)
 
 
 class AlgorithmBase(QgsProcessingAlgorithm):
@@ -45,6 +80,7 @@ class AlgorithmBase(QgsProcessingAlgorithm):
             False: collections.OrderedDict(),
         }
         self.skip_logic = {}
+        self.profiler = Profiler()
 
     def addParameter(
         self,
@@ -70,11 +106,27 @@ class AlgorithmBase(QgsProcessingAlgorithm):
 
         return any(p.name() == key for p in self.parameterDefinitions())
 
+    def is_constant_expr(self, expression):
+        """Helper to check whether a prepared expression gives the same value for all features
+
+        This is the case for literals (such as most default values), and for expressions that QGIS
+        found to be static when preparing them (QGIS 3.20+).
+        """
+        root = expression.rootNode()
+        if root is None or expression.hasParserError():
+            return False
+        if root.nodeType() == QgsExpressionNode.ntLiteral:
+            return True
+        has_static_value = getattr(root, "hasCachedStaticValue", None)
+        return has_static_value is not None and has_static_value()
+
     def eval_expr(self, key):
         """Helper to evaluate an expression from the input.
 
         Do not forget to call self.expressions_context.setFeature(feature) before using this.
         """
+        if key in self.constant_values:
+            return self.constant_values[key]
         if key in self.params:
             return self.params[key].evaluate(self.expressions_context)
         else:
@@ -89,7 +141,12 @@ class AlgorithmBase(QgsProcessingAlgorithm):
         )
         # We save parameters to the instance to access it in postprocess
         self.raw_parameters = parameters
-        return self.doProcessAlgorithm(parameters, context, feedback)
+        # Timings of the run, reported in postProcessAlgorithm
+        self.profiler = Profiler()
+        with self.profiler.phase("processing"):
+            results = self.doProcessAlgorithm(parameters, context, feedback)
+        self.processing_ended = time.monotonic()
+        return results
 
     def doProcessAlgorithm(self, parameters, context, feedback):
         raise NotImplemented("Method must be reimplemented by subclass")
@@ -98,6 +155,8 @@ class AlgorithmBase(QgsProcessingAlgorithm):
         """Helper method that sets up all expressions parameter"""
         self.expressions_context = self.createExpressionContext(parameters, context)
         self.params = {}
+        # Values of the expressions that don't depend on the feature, evaluated once
+        self.constant_values = {}
         for p in self.parameterDefinitions():
             param = None
             if p.type() == "expression":
@@ -105,6 +164,10 @@ class AlgorithmBase(QgsProcessingAlgorithm):
                     self.parameterAsExpression(parameters, p.name(), context)
                 )
                 param.prepare(self.expressions_context)
+                if self.is_constant_expr(param):
+                    self.constant_values[p.name()] = param.evaluate(
+                        self.expressions_context
+                    )
             elif p.type() == "source":
                 param = self.parameterAsSource(parameters, p.name(), context)
             elif p.type() == "enum":
@@ -145,6 +208,12 @@ class AlgorithmBase(QgsProcessingAlgorithm):
     def postProcessAlgorithm(self, context, feedback):
         """Sets the layer metadata"""
 
+        # Subclasses run their post-processing before calling this
+        self.profiler.record(
+            "post-processing", time.monotonic() - self.processing_ended
+        )
+        feedback.pushDebugInfo("Timings :\n" + self.profiler.table())
+
         if hasattr(self, "sink_id") and self.sink_id is not None:
             layer = QgsProcessingUtils.mapLayerFromString(self.sink_id, context)
 
@@ -178,6 +247,7 @@ class AlgorithmBase(QgsProcessingAlgorithm):
                     "TTP_VERSION": [constants.TTP_VERSION],
                     "TTP_ALGORITHM": [self.id()],
                     "TTP_PARAMS": [params_json],
+                    "TTP_PROFILE": [json.dumps(self.profiler.summary())],
                 }
             )
             layer.setMetadata(metadata)
@@ -237,6 +307,8 @@ class ProcessingAlgorithmBase(AlgorithmBase):
     method = "POST"
     accept_header = "application/json"
     output_aliases = {}
+    # Whether whole responses are stored in the requests cache
+    cache_responses = True
 
     def initAlgorithm(self, config):
         self.addParameter(
@@ -274,6 +346,9 @@ class ProcessingAlgorithmBase(AlgorithmBase):
         # By default, we count 1 search
         return 1
 
+    def processAlgorithmResponseReceived(self, data, response, duration):
+        """To be overriden by subclasses : called (possibly from a worker thread) with each response and the time it took"""
+
     def processAlgorithmMakeRequest(
         self, parameters, context, feedback, data=None, params={}
     ):
@@ -286,7 +361,8 @@ class ProcessingAlgorithmBase(AlgorithmBase):
             )
             raise QgsProcessingException("Algorithm was cancelled by the user.")
 
-        json_data = json.dumps(data)
+        with self.profiler.phase("encode request"):
+            json_data = json.dumps(data)
 
         # Get API key
         if not self.APP_ID or not self.API_KEY:
@@ -338,17 +414,23 @@ class ProcessingAlgorithmBase(AlgorithmBase):
                 )
             )
 
-        request = requests.Request(
-            self.method,
-            full_url,
-            data=json_data,
-            params=params,
-            headers=headers,
-        ).prepare()
-
-        cached = cache.instance.cached_requests.cache.has_key(
-            cache.instance.cached_requests.cache.create_key(request)
+        # Prepare through the session, so that its default headers (keep-alive, gzip...) are used
+        request = cache.instance.cached_requests.prepare_request(
+            requests.Request(
+                self.method,
+                full_url,
+                data=json_data,
+                params=params,
+                headers=headers,
+            )
         )
+
+        if self.cache_responses:
+            session = cache.instance.cached_requests
+            cached = session.cache.has_key(session.cache.create_key(request))
+        else:
+            session = cache.instance.session
+            cached = False
         throttling_disabled = (
             THROTTLING_STRATEGIES[self.params["INPUT_THROTTLING_STRATEGY"]]
             == THROTTLING_DISABLED
@@ -369,32 +451,60 @@ class ProcessingAlgorithmBase(AlgorithmBase):
                         throttler.DURATION,
                     )
                 )
-                wait_until = datetime.datetime.now() + datetime.timedelta(
-                    seconds=throttling
+                with self.profiler.phase("throttling"):
+                    self.processAlgorithmWait(feedback, throttling)
+
+        for attempt in range(MAX_RETRIES + 1):
+            # Slow down if the API asked to (cached responses don't reach the API, like for throttling)
+            if not cached:
+                delay = rate_controller.reserve()
+                if delay > 0:
+                    with self.profiler.phase("rate limiting"):
+                        self.processAlgorithmWait(feedback, delay)
+
+            try:
+                started = time.monotonic()
+                response = session.send(request, verify=not disable_https)
+                duration = time.monotonic() - started
+                if not self.cache_responses:
+                    response.from_cache = False
+                self.profiler.record(
+                    "cache lookup" if response.from_cache else "network", duration
                 )
-                while datetime.datetime.now() <= wait_until:
-                    if feedback.isCanceled():
-                        raise QgsProcessingException("Canceled by user") from None
-                    QTest.qWait(100)
-
-        try:
-            response = cache.instance.cached_requests.send(
-                request, verify=not disable_https
+            except requests.exceptions.RequestException as e:
+                feedback.reportError(
+                    tr(
+                        "Error while connecting to the API server. See log for more details."
+                    ),
+                    fatalError=True,
+                )
+                log(e)
+                raise QgsProcessingException(
+                    "Error while connecting to the API server"
+                ) from None
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                if not response.from_cache:
+                    rate_controller.speed_up()
+                break
+            if attempt == MAX_RETRIES:
+                break
+
+            rate_controller.slow_down()
+            delay = rate_controller.retry_delay(
+                attempt, response.headers.get("Retry-After")
             )
-        except requests.exceptions.RequestException as e:
-            feedback.reportError(
-                tr(
-                    "Error while connecting to the API server. See log for more details."
-                ),
-                fatalError=True,
+            feedback.pushWarning(
+                tr("Got error {} from API, retrying in {}s ({}/{})").format(
+                    response.status_code, round(delay), attempt + 1, MAX_RETRIES
+                )
             )
-            log(e)
-            raise QgsProcessingException(
-                "Error while connecting to the API server"
-            ) from None
+            with self.profiler.phase("rate limiting"):
+                self.processAlgorithmWait(feedback, delay)
 
         try:
-            response_data = json.loads(response.text)
+            with self.profiler.phase("decode response"):
+                response_data = json.loads(response.text)
         except ValueError as e:
             feedback.reportError(
                 tr("Could not decode response. See log for more details."),
@@ -423,8 +533,9 @@ class ProcessingAlgorithmBase(AlgorithmBase):
             )
             feedback.reportError(tr("See log for more details."), fatalError=True)
             log(e)
-            raise QgsProcessingException(
-                "Got error {} from API".format(response.status_code)
+            raise ApiError(
+                "Got error {} from API".format(response.status_code),
+                response.status_code,
             ) from None
         except requests.exceptions.SSLError as e:
             feedback.reportError(
@@ -445,14 +556,24 @@ class ProcessingAlgorithmBase(AlgorithmBase):
             log(e)
             raise QgsProcessingException("Could not connect to API") from None
 
+        # Algorithms that cache searches rather than responses count each search
+        entries_count = (
+            1
+            if self.cache_responses
+            else self.processAlgorithmComputeSearchCountForThrottling(data)
+        )
+        cache.instance.record(response.from_cache, len(response.content), entries_count)
         if response.from_cache:
             feedback.pushDebugInfo("Got response from cache...")
         else:
             feedback.pushDebugInfo("Got response from API endpoint...")
-            QSettings().setValue(
-                "traveltime_platform/current_count",
-                int(QSettings().value("traveltime_platform/current_count", 0)) + 1,
-            )
+            with _count_lock:
+                QSettings().setValue(
+                    "traveltime_platform/current_count",
+                    int(QSettings().value("traveltime_platform/current_count", 0)) + 1,
+                )
+
+        self.processAlgorithmResponseReceived(data, response, duration)
 
         if print_query:
             log("Got response")
@@ -462,8 +583,107 @@ class ProcessingAlgorithmBase(AlgorithmBase):
 
         return response_data
 
+    def processAlgorithmOutputSink(
+        self, parameters, name, context, fields, geometry_type, crs, feedback
+    ):
+        """Creates the output sink, wrapped to write features in chunks
+
+        Returns (sink, sink_id) like parameterAsSink. Call sink.finish() once all features are added.
+        """
+        (sink, sink_id) = self.parameterAsSink(
+            parameters, name, context, fields, geometry_type, crs
+        )
+        return BufferedSink(sink, feedback, profiler=self.profiler), sink_id
+
+    def processAlgorithmWait(self, feedback, seconds):
+        """Waits for the given duration, raising if the algorithm gets cancelled meanwhile
+
+        This sleeps until the deadline or the cancellation without polling. On the main thread, an event
+        loop runs meanwhile so that the interface (and its cancel button) stays responsive.
+        """
+        if seconds > 0 and not feedback.isCanceled():
+            app = QCoreApplication.instance()
+            if app is not None and QThread.currentThread() == app.thread():
+                loop = QEventLoop()
+                timer = QTimer()
+                timer.setSingleShot(True)
+                timer.timeout.connect(loop.quit)
+                feedback.canceled.connect(loop.quit)
+                try:
+                    timer.start(int(seconds * 1000))
+                    if not feedback.isCanceled():
+                        loop.exec_()
+                finally:
+                    timer.stop()
+                    feedback.canceled.disconnect(loop.quit)
+            else:
+                # The signal is emitted from the thread that cancels (usually the main thread), which
+                # sets the event directly as this thread may not run an event loop
+                event = threading.Event()
+                wake = event.set
+                feedback.canceled.connect(wake, Qt.DirectConnection)
+                try:
+                    if not feedback.isCanceled():
+                        event.wait(seconds)
+                finally:
+                    feedback.canceled.disconnect(wake)
+        if feedback.isCanceled():
+            raise QgsProcessingException("Canceled by user") from None
+
+    def processAlgorithmMakeRequests(
+        self, parameters, context, feedback, requests_kwargs
+    ):
+        """Helper method to make several requests concurrently
+
+        requests_kwargs is an iterable of keyword arguments (data/params) for processAlgorithmMakeRequest. It is
+        consumed lazily from the calling thread, so that no more requests than the configured amount of
+        concurrent requests are prepared or in flight at once. Responses are yielded in the same order.
+        """
+        max_workers = max(
+            1,
+            QSettings().value("traveltime_platform/concurrent_requests", 4, type=int),
+        )
+        requests_kwargs = iter(requests_kwargs)
+        workers_feedback = SerializedFeedback(feedback)
+        pending = collections.deque()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while True:
+                    # Keep the workers busy
+                    while len(pending) < max_workers and not feedback.isCanceled():
+                        kwargs = next(requests_kwargs, None)
+                        if kwargs is None:
+                            break
+                        pending.append(
+                            executor.submit(
+                                self.processAlgorithmMakeRequest,
+                                parameters,
+                                context,
+                                workers_feedback,
+                                **kwargs,
+                            )
+                        )
+
+                    if not pending:
+                        break
+
+                    # Wait for the oldest request, so that responses are yielded in order
+                    yield pending.popleft().result()
+            finally:
+                # Don't start requests that are still queued (on error, cancellation or when the
+                # responses aren't needed anymore), and stop those that are waiting to be sent
+                for future in pending:
+                    future.cancel()
+                workers_feedback.stop()
+
+        if feedback.isCanceled():
+            raise QgsProcessingException("Algorithm was cancelled by the user.")
+
     def postProcessAlgorithm(self, context, feedback):
-        """Sets the field aliases"""
+        """Sets the field aliases and prunes the cache"""
+
+        cache.instance.prune_in_background()
 
         if hasattr(self, "sink_id") and self.sink_id is not None:
             layer = QgsProcessingUtils.mapLayerFromString(self.sink_id, context)
@@ -140,7 +140,8 @@ class _SimpleSearchAlgorithmBase(AlgorithmBase):
 
     def doProcessAlgorithm(self, parameters, context, feedback):
         # Configure common expressions inputs
-        self.processAlgorithmConfigureParams(parameters, context, feedback)
+        with self.profiler.phase("configure parameters"):
+            self.processAlgorithmConfigureParams(parameters, context, feedback)
 
         # Prepare parameters for the sub algorithm
         sub_parameters = self.processAlgorithmPrepareSubParameters(
@@ -1,15 +1,19 @@
+import datetime
+import time
+
 from qgis.core import (
     QgsCoordinateTransform,
     QgsFeature,
-    QgsFeatureSink,
     QgsField,
     QgsFields,
     QgsPoint,
     QgsProcessing,
+    QgsProcessingException,
     QgsProcessingParameterEnum,
     QgsProcessingParameterExpression,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterPoint,
     QgsWkbTypes,
 )
@@ -68,18 +72,49 @@ class GeocodingAlgorithmBase(ProcessingAlgorithmBase):
 
     def doProcessAlgorithm(self, parameters, context, feedback):
         # Configure common expressions inputs
-        self.processAlgorithmConfigureParams(parameters, context, feedback)
+        with self.profiler.phase("configure parameters"):
+            self.processAlgorithmConfigureParams(parameters, context, feedback)
 
         # Main implementation
         source_data = self.params["INPUT_DATA"]
         limit_country_chc = self.params["INPUT_COUNTRY"]
         limit_country = COUNTRIES[limit_country_chc][0] if limit_country_chc else None
 
-        if source_data.featureCount() > 1:
+        # Read the input features, preparing their queries. Features with the same query share
+        # the same response, so each unique query is only sent once.
+        features = []
+        features_keys = []
+        queries = {}
+        for feature in source_data.getFeatures():
+            if feedback.isCanceled():
+                raise QgsProcessingException("Algorithm was cancelled by the user.")
+
+            # Set feature for expression context
+            self.expressions_context.setFeature(feature)
+
+            # Prepare the data
+            params = self.processAlgorithmMakeGetParams(
+                feature, source_data, parameters, context, feedback
+            )
+            if limit_country:
+                params.update({"within.country": limit_country})
+
+            key = self.processAlgorithmQueryKey(params)
+            queries.setdefault(key, params)
+            features.append(feature)
+            features_keys.append(key)
+
+        if len(queries) < len(features):
+            feedback.pushInfo(
+                tr("The {} input features share {} unique queries.").format(
+                    len(features), len(queries)
+                )
+            )
+        if len(queries) > 1:
             feedback.pushInfo(
                 tr(
                     "Input layer has multiple features. The query will be executed in {} queries. This may have unexpected consequences on some parameters. Keep an eye on your API usage !"
-                ).format(source_data.featureCount())
+                ).format(len(queries))
             )
 
         # Configure output
@@ -102,39 +137,51 @@ class GeocodingAlgorithmBase(ProcessingAlgorithmBase):
         ]
         for attr in response_attributes:
             output_fields.append(QgsField("geocoded_" + attr, QVariant.String, "text"))
-
-        (sink, sink_id) = self.parameterAsSink(
-            parameters, "OUTPUT", context, output_fields, QgsWkbTypes.Point, EPSG4326
+        no_response_attributes = [None] * len(response_attributes)
+
+        (sink, sink_id) = self.processAlgorithmOutputSink(
+            parameters,
+            "OUTPUT",
+            context,
+            output_fields,
+            QgsWkbTypes.Point,
+            EPSG4326,
+            feedback,
         )
 
-        for feature in source_data.getFeatures():
-            # Set feature for expression context
-            self.expressions_context.setFeature(feature)
-
-            # Prepare the data
-            source_data = self.params["INPUT_DATA"]
-            limit_country_chc = self.params["INPUT_COUNTRY"]
-            limit_country = (
-                COUNTRIES[limit_country_chc][0] if limit_country_chc else None
-            )
-
-            params = self.processAlgorithmMakeGetParams(
-                feature, source_data, parameters, context, feedback
+        # Make the queries (several at once), reporting progress as the responses arrive
+        keys = list(queries.keys())
+        responses = {}
+        started = time.monotonic()
+        for key, response_geojson in zip(
+            keys,
+            self.processAlgorithmMakeRequests(
+                parameters,
+                context,
+                feedback,
+                ({"params": queries[key]} for key in keys),
+            ),
+        ):
+            responses[key] = response_geojson
+
+            done = len(responses)
+            elapsed = time.monotonic() - started
+            remaining = elapsed / done * (len(keys) - done)
+            feedback.setProgress(100 * done / len(keys))
+            feedback.setProgressText(
+                tr("Geocoded {} of {} queries (about {} remaining)").format(
+                    done, len(keys), datetime.timedelta(seconds=round(remaining))
+                )
             )
-            if limit_country:
-                params.update({"within.country": limit_country})
 
-            # Make the query
-            response_geojson = self.processAlgorithmMakeRequest(
-                parameters, context, feedback, params=params
-            )
+        result_type = self.RESULT_TYPE[self.params["OUTPUT_RESULT_TYPE"]]
+        for feature, key in zip(features, features_keys):
+            response_geojson = responses[key]
 
             # Process the results
-            result_type = self.RESULT_TYPE[self.params["OUTPUT_RESULT_TYPE"]]
-
             if result_type == "ALL":
-                # We keep all results
-                results = response_geojson["features"]
+                # We keep all results (copied, as the response may be shared with other features)
+                results = list(response_geojson["features"])
             elif result_type == "BEST_MATCH":
                 # We only keep the result wit the best score
                 results = sorted(
@@ -146,21 +193,21 @@ class GeocodingAlgorithmBase(ProcessingAlgorithmBase):
             if len(results) == 0:
                 results.append(None)
 
+            # Clone the existing attributes
+            source_attributes = feature.attributes()
+
             for result in results:
                 newfeature = QgsFeature(output_fields)
 
-                # Clone the existing attributes
-                for i in range(len(source_data.fields())):
-                    newfeature.setAttribute(i, feature.attribute(i))
-
-                if result is not None:
+                if result is None:
+                    newfeature.setAttributes(source_attributes + no_response_attributes)
+                else:
                     # Add our attributes
                     props = result["properties"]
-                    for attr in response_attributes:
-                        output_fields.append(QgsField(attr, QVariant.String, "text"))
-                        newfeature.setAttribute(
-                            "geocoded_" + attr, props[attr] if attr in props else None
-                        )
+                    newfeature.setAttributes(
+                        source_attributes
+                        + [props.get(attr) for attr in response_attributes]
+                    )
 
                     # Add our geometry
                     newfeature.setGeometry(
@@ -170,7 +217,9 @@ class GeocodingAlgorithmBase(ProcessingAlgorithmBase):
                         )
                     )
 
-                sink.addFeature(newfeature, QgsFeatureSink.FastInsert)
+                sink.addFeature(newfeature)
+
+        sink.finish()
 
         # to get hold of the layer in post processing
         self.sink_id = sink_id
@@ -181,6 +230,11 @@ class GeocodingAlgorithmBase(ProcessingAlgorithmBase):
         """To be overriden by subclasses"""
         return {}
 
+    def processAlgorithmQueryKey(self, params):
+        """Returns a key identifying the query, so that identical queries are only sent once"""
+        # Values may not be hashable (e.g. NULL), so they are keyed by their type and string
+        return tuple(sorted((k, type(v).__name__, str(v)) for k, v in params.items()))
+
 
 class GeocodingAlgorithm(GeocodingAlgorithmBase):
     input_type = QgsProcessing.TypeVector
@@ -221,7 +275,11 @@ class GeocodingAlgorithm(GeocodingAlgorithmBase):
     def processAlgorithmMakeGetParams(
         self, feature, source_data, parameters, context, feedback
     ):
-        params = {"query": self.eval_expr("INPUT_QUERY_FIELD")}
+        query = self.eval_expr("INPUT_QUERY_FIELD")
+        if isinstance(query, str):
+            # Normalize whitespace, so that the same queries get deduplicated
+            query = " ".join(query.split())
+        params = {"query": query}
         if self.params["INPUT_FOCUS"]:
             params.update(
                 {
@@ -231,6 +289,13 @@ class GeocodingAlgorithm(GeocodingAlgorithmBase):
             )
         return params
 
+    def processAlgorithmQueryKey(self, params):
+        # The geocoder is not case sensitive
+        query = params["query"]
+        if isinstance(query, str):
+            params = {**params, "query": query.casefold()}
+        return super().processAlgorithmQueryKey(params)
+
 
 class ReverseGeocodingAlgorithm(GeocodingAlgorithmBase):
     input_type = QgsProcessing.TypeVectorPoint
@@ -247,6 +312,22 @@ class ReverseGeocodingAlgorithm(GeocodingAlgorithmBase):
         "This algorithms provides access to the reverse geocoding endpoint.\n\nPlease see the help on {url} for more details on how to use it."
     ).format(url=_helpUrl)
 
+    def initAlgorithm(self, config):
+        super().initAlgorithm(config)
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                "INPUT_PRECISION",
+                tr("Coordinates precision (decimals)"),
+                defaultValue=5,
+                minValue=0,
+                maxValue=8,
+            ),
+            advanced=True,
+            help_text=tr(
+                "Points whose coordinates are equal once rounded to this amount of decimals (5 is about 1 meter) are only queried once, using the coordinates of the first of them."
+            ),
+        )
+
     def processAlgorithmMakeGetParams(
         self, feature, source_data, parameters, context, feedback
     ):
@@ -254,5 +335,18 @@ class ReverseGeocodingAlgorithm(GeocodingAlgorithmBase):
             source_data.sourceCrs(), EPSG4326, context.transformContext()
         )
         focus_point = xform.transform(feature.geometry().asPoint())
-        params = {"lat": focus_point.y(), "lng": focus_point.x()}
+        params = {
+            "lat": focus_point.y(),
+            "lng": focus_point.x(),
+        }
         return params
+
+    def processAlgorithmQueryKey(self, params):
+        # Points that are close to each other share the same query (with the coordinates of the first one)
+        precision = self.params["INPUT_PRECISION"]
+        params = {
+            **params,
+            "lat": round(params["lat"], precision),
+            "lng": round(params["lng"], precision),
+        }
+        return super().processAlgorithmQueryKey(params)
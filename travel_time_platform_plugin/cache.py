@@ -1,43 +1,260 @@
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
 
-from qgis.PyQt.QtCore import QStandardPaths
+import requests
+from qgis.core import Qgis
+from qgis.PyQt.QtCore import QSettings, QStandardPaths
+from requests.adapters import HTTPAdapter
 
 from .libraries import requests_cache
+from .libraries.requests_cache.backends.sqlite import DbCache
+from .libraries.requests_cache.backends.storage.dbdict import DbPickleDict
+from .utils import log
 
+EXPIRE_AFTER = timedelta(seconds=86400)
 
-class Cache:
-    def __init__(self):
-        base = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
 
-        if not os.path.exists(base):
-            os.makedirs(base, exist_ok=True)
-        self.path = os.path.join(base, "ttp_cache.sqlite")
+def format_size(num):
+    # https://gist.github.com/cbwar/d2dfbc19b140bd599daccbe0fe925597
+    for unit in ["", "k", "M", "G", "T", "P", "E", "Z"]:
+        if abs(num) < 1024.0:
+            return "%3.1f %s%s" % (num, unit, "b")
+        num /= 1024.0
+    return "%.1f%s%s" % (num, "Yi", "b")
+
+
+class CompressedDbCache(DbCache):
+    """Sqlite cache backend storing slim, compressed responses
+
+    Only what is read from the responses is kept (the request, cookies and raw response are dropped),
+    and the body is compressed with zlib."""
+
+    # Headers kept on cached responses (used to guess the encoding of the body)
+    kept_headers = ["Content-Type"]
+
+    def reduce_response(self, response, seen=None):
+        return {
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "url": response.url,
+            "encoding": response.encoding,
+            "headers": {
+                k: response.headers[k]
+                for k in self.kept_headers
+                if k in response.headers
+            },
+            "content": zlib.compress(response.content),
+        }
+
+    def restore_response(self, response, seen=None):
+        if not isinstance(response, dict):
+            # Responses cached by previous versions
+            return super().restore_response(response, seen)
+        result = requests.Response()
+        result.status_code = response["status_code"]
+        result.reason = response["reason"]
+        result.url = response["url"]
+        result.encoding = response["encoding"]
+        result.headers.update(response["headers"])
+        result._content = zlib.decompress(response["content"])
+        return result
+
+    def delete(self, key):
+        """Deletes the response of `key`, along with all keys mapped to it
+
+        Overriden as the base implementation finds the mapped keys through the response's history,
+        which slim records don't keep."""
+        if key not in self.responses:
+            try:
+                key = self.keys_map.peek(key)
+            except KeyError:
+                return
+        self.delete_responses([key])
+
+    def delete_responses(self, keys):
+        """Deletes several responses at once, along with all keys mapped to them"""
+        keys = set(keys)
+        self.responses.delete_keys(keys)
+        aliases = []
+        for alias in self.keys_map:
+            try:
+                if self.keys_map.peek(alias) in keys:
+                    aliases.append(alias)
+            except KeyError:
+                pass
+        self.keys_map.delete_keys(aliases)
+
+
+class Cache:
+    def __init__(self, path=None):
+        if path is None:
+            base = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
+            if not os.path.exists(base):
+                os.makedirs(base, exist_ok=True)
+            path = os.path.join(base, "ttp_cache.sqlite")
+        self.path = path
 
         self.cached_requests = None
+        self.searches = None
+        self.session = None
+        self.pool_size = None
+
+        # Statistics for the current session
+        self.stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_from_cache = 0
+        self.bytes_from_api = 0
+
+        self.pruning_lock = threading.Lock()
 
         self.prepare()
 
     def clear(self):
         self.cached_requests.cache.clear()
+        self.searches.clear()
 
     def size(self):
-        if os.path.exists(self.path):
-            num = os.path.getsize(self.path)
-            # https://gist.github.com/cbwar/d2dfbc19b140bd599daccbe0fe925597
-            for unit in ["", "k", "M", "G", "T", "P", "E", "Z"]:
-                if abs(num) < 1024.0:
-                    return "%3.1f %s%s" % (num, unit, "b")
-                num /= 1024.0
-            return "%.1f%s%s" % (num, "Yi", "b")
-        return "0b"
+        # Changes are written to the write-ahead log before being moved to the database
+        paths = [self.path, self.path + "-wal"]
+        return format_size(sum(os.path.getsize(p) for p in paths if os.path.exists(p)))
+
+    def record(self, from_cache, size, count=1):
+        """Counts `count` cache entries (responses, or searches of the time-map algorithm) in the statistics"""
+        with self.stats_lock:
+            if from_cache:
+                self.hits += count
+                self.bytes_from_cache += size
+            else:
+                self.misses += count
+                self.bytes_from_api += size
+
+    def prune(self):
+        """Removes expired entries, then evicts the least recently used ones until the cache fits the maximum size"""
+
+        # Only one pruning at a time
+        if not self.pruning_lock.acquire(blocking=False):
+            return
+        try:
+            self.cached_requests.remove_expired_responses()
+            self.searches.delete_created_before(
+                time.time() - EXPIRE_AFTER.total_seconds()
+            )
+
+            max_size = QSettings().value(
+                "traveltime_platform/cache_max_size", 1024, type=int
+            )
+            if not max_size:
+                return
+
+            # Items are (last access, size, index of the table, key)
+            tables = [self.cached_requests.cache.responses, self.searches]
+            items = [
+                (accessed or 0, size or 0, index, key)
+                for index, table in enumerate(tables)
+                for key, size, accessed in table.usage()
+            ]
+            total = sum(item[1] for item in items)
+            to_evict = [[] for _ in tables]
+            for _, size, index, key in sorted(items, key=lambda item: item[0]):
+                if total <= max_size * 1024 * 1024:
+                    break
+                to_evict[index].append(key)
+                total -= size
+
+            responses_to_evict, searches_to_evict = to_evict
+            if responses_to_evict or searches_to_evict:
+                # Keys mapped to the evicted responses are deleted too
+                self.cached_requests.cache.delete_responses(responses_to_evict)
+                self.searches.delete_keys(searches_to_evict)
+                # Actually shrink the file (this fails if another connection is writing)
+                try:
+                    self.searches.vacuum()
+                except sqlite3.OperationalError as e:
+                    log(f"Could not vacuum the cache : {e}", level=Qgis.Warning)
+        finally:
+            self.pruning_lock.release()
+
+    def prune_in_background(self):
+        threading.Thread(target=self.prune, daemon=True).start()
 
     def prepare(self):
         self.cached_requests = requests_cache.core.CachedSession(
-            cache_name=os.path.splitext(self.path)[0],
-            backend="sqlite",
-            expire_after=86400,
+            backend=CompressedDbCache(os.path.splitext(self.path)[0]),
+            expire_after=EXPIRE_AFTER,
             allowable_methods=("GET", "POST"),
         )
+        # Results of individual searches, so that they can be reused across differently batched requests
+        self.searches = DbPickleDict(self.path, "searches")
+        # For requests that must not be cached (such as checking access to tiles)
+        self.session = requests.Session()
+        self.pool_size = None
+        self.configure_pool()
+
+    def configure_pool(self):
+        """Mounts a connection pool sized to the amount of concurrent requests
+
+        Both sessions share the same adapter, so that connections (and thus their TLS sessions) are
+        kept alive and reused across requests and algorithm runs."""
+
+        pool_size = max(
+            1, QSettings().value("traveltime_platform/concurrent_requests", 4, type=int)
+        )
+        if pool_size == self.pool_size:
+            return
+
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        previous_adapters = set()
+        for session in [self.cached_requests, self.session]:
+            for prefix in ["https://", "http://"]:
+                if prefix in session.adapters:
+                    previous_adapters.add(session.adapters[prefix])
+                session.mount(prefix, adapter)
+        # Close the sockets of the replaced pools (connections in use are closed once released)
+        for previous_adapter in previous_adapters:
+            previous_adapter.close()
+        self.pool_size = pool_size
+
+    def search_key(self, endpoint, search):
+        """Returns the cache key of a search, which depends on all its parameters except its id"""
+        search = {k: v for k, v in search.items() if k != "id"}
+        serialized = json.dumps([endpoint, search], sort_keys=True)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def has_search(self, key):
+        """Returns whether a search is cached and not expired, without reading its result"""
+        try:
+            created = self.searches.created(key)
+        except KeyError:
+            return False
+        return (
+            created is not None
+            and time.time() - created <= EXPIRE_AFTER.total_seconds()
+        )
+
+    def get_search(self, key):
+        """Returns the cached result of a search and its size (uncompressed), or (None, 0) if it's not cached or expired"""
+        try:
+            result, timestamp = self.searches[key]
+        except KeyError:
+            return None, 0
+        if datetime.utcnow() - timestamp > EXPIRE_AFTER:
+            return None, 0
+        if not isinstance(result, bytes):
+            # Entries saved before searches were compressed
+            return result, len(json.dumps(result))
+        serialized = zlib.decompress(result)
+        return json.loads(serialized), len(serialized)
+
+    def save_search(self, key, result):
+        compressed = zlib.compress(json.dumps(result).encode("utf-8"))
+        self.searches[key] = (compressed, datetime.utcnow())
 
 
 instance = Cache()
@@ -6,6 +6,8 @@
 
     ``sqlite3`` cache backend
 """
+import calendar
+
 from .base import BaseCache
 from .storage.dbdict import DbDict, DbPickleDict
 
@@ -27,3 +29,10 @@ class DbCache(BaseCache):
         super(DbCache, self).__init__(**options)
         self.responses = DbPickleDict(location + extension, 'responses', fast_save=fast_save)
         self.keys_map = DbDict(location + extension, 'urls')
+
+    def remove_old_entries(self, created_before):
+        """ Deletes entries from cache with creation time older than ``created_before``,
+        using the indexed creation time rather than unpickling every response
+        """
+        self.responses.delete_created_before(
+            calendar.timegm(created_before.utctimetuple()))
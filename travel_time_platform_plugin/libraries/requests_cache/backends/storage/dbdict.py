@@ -12,6 +12,7 @@ except ImportError:
     from collections import MutableMapping
 
 import sqlite3 as sqlite
+import time
 from contextlib import contextmanager
 try:
     import threading
@@ -24,6 +25,9 @@ except ImportError:
 
 from ...compat import bytes
 
+#: Last access times are only updated if older than this (in seconds), to avoid a write on each read
+ACCESS_RESOLUTION = 60
+
 
 class DbDict(MutableMapping):
     """ DbDict - a dictionary-like object for saving large datasets to `sqlite` database
@@ -55,32 +59,63 @@ class DbDict(MutableMapping):
         #: Transactions can be committed if this property is set to `True`
         self.can_commit = True
 
-        
-        self._bulk_commit = False
-        self._pending_connection = None
-        self._lock = threading.RLock()
-        with self.connection() as con:
-            con.execute("create table if not exists `%s` (key PRIMARY KEY, value)" % self.table_name)
+        # Each thread keeps its own connection open, so that connections (and the
+        # statements they cache) are reused, and so that threads can read in parallel
+        self._local = threading.local()
+
+        # Statements are built once, so that sqlite3's statement cache is hit
+        table = "`%s`" % table_name
+        self._sql = {
+            "get": "select value, accessed from %s where key=?" % table,
+            "touch": "update %s set accessed=? where key=?" % table,
+            "peek": "select value from %s where key=?" % table,
+            "contains": "select 1 from %s where key=?" % table,
+            "created": "select created from %s where key=?" % table,
+            "set": "insert or replace into %s (key,value,accessed,created) values (?,?,?,?)" % table,
+            "del": "delete from %s where key=?" % table,
+            "iter": "select key from %s" % table,
+            "len": "select count(key) from %s" % table,
+            "usage": "select key, length(value), accessed from %s" % table,
+            "expire": "delete from %s where created < ? or created is null" % table,
+        }
 
+        with self.connection(True) as con:
+            # Write-ahead logging lets readers work while another connection writes
+            con.execute("PRAGMA journal_mode = WAL;")
+            self._create_table(con)
+
+    def _create_table(self, con):
+        con.execute("create table if not exists `%s` (key PRIMARY KEY, value, accessed REAL, created REAL)" % self.table_name)
+        # Tables created by previous versions have no access nor creation time
+        columns = [row[1] for row in con.execute("pragma table_info(`%s`)" % self.table_name)]
+        for column in ["accessed", "created"]:
+            if column not in columns:
+                con.execute("alter table `%s` add column %s REAL" % (self.table_name, column))
+        con.execute("create index if not exists `%s_created` on `%s` (created)" %
+                    (self.table_name, self.table_name))
+
+    def _connection(self):
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            # The connection is only used by this thread, but it may be garbage collected by another one
+            con = sqlite.connect(self.filename, timeout=30, check_same_thread=False)
+            if self.fast_save:
+                con.execute("PRAGMA synchronous = 0;")
+            self._local.connection = con
+        return con
 
     @contextmanager
     def connection(self, commit_on_success=False):
-        with self._lock:
-            if self._bulk_commit:
-                if self._pending_connection is None:
-                    self._pending_connection = sqlite.connect(self.filename)
-                con = self._pending_connection
-            else:
-                con = sqlite.connect(self.filename)
-            try:
-                if self.fast_save:
-                    con.execute("PRAGMA synchronous = 0;")
-                yield con
-                if commit_on_success and self.can_commit:
-                    con.commit()
-            finally:
-                if not self._bulk_commit:
-                    con.close()
+        con = self._connection()
+        bulk = getattr(self._local, "bulk_commit", False)
+        try:
+            yield con
+        except Exception:
+            if not bulk:
+                con.rollback()
+            raise
+        if commit_on_success and self.can_commit and not bulk:
+            con.commit()
 
     def commit(self, force=False):
         """
@@ -89,8 +124,7 @@ class DbDict(MutableMapping):
         :param force: force commit, ignore :attr:`can_commit`
         """
         if force or self.can_commit:
-            if self._pending_connection is not None:
-                self._pending_connection.commit()
+            self._connection().commit()
 
     @contextmanager
     def bulk_commit(self):
@@ -104,54 +138,99 @@ class DbDict(MutableMapping):
             ...         d1[i] = i * 2
 
         """
-        self._bulk_commit = True
-        self.can_commit = False
+        self._local.bulk_commit = True
         try:
             yield
             self.commit(True)
         finally:
-            self._bulk_commit = False
-            self.can_commit = True
-            if self._pending_connection is not None:
-                self._pending_connection.close()
-                self._pending_connection = None
+            self._local.bulk_commit = False
+            self._connection().rollback()
 
     def __getitem__(self, key):
+        with self.connection(True) as con:
+            row = con.execute(self._sql["get"], (key,)).fetchone()
+            if not row:
+                raise KeyError
+            now = time.time()
+            if row[1] is None or now - row[1] > ACCESS_RESOLUTION:
+                con.execute(self._sql["touch"], (now, key))
+            return row[0]
+
+    def peek(self, key):
+        """ Same as ``self[key]``, but without updating the last access time
+        """
+        with self.connection() as con:
+            row = con.execute(self._sql["peek"], (key,)).fetchone()
+            if not row:
+                raise KeyError
+            return row[0]
+
+    def __contains__(self, key):
+        # Avoids reading (and unpickling) the value
         with self.connection() as con:
-            row = con.execute("select value from `%s` where key=?" %
-                              self.table_name, (key,)).fetchone()
+            return con.execute(self._sql["contains"], (key,)).fetchone() is not None
+
+    def created(self, key):
+        """ Returns the creation time of ``key`` (in seconds since epoch, None for items saved by
+        previous versions), without reading its value
+        """
+        with self.connection() as con:
+            row = con.execute(self._sql["created"], (key,)).fetchone()
             if not row:
                 raise KeyError
             return row[0]
 
     def __setitem__(self, key, item):
         with self.connection(True) as con:
-            con.execute("insert or replace into `%s` (key,value) values (?,?)" %
-                        self.table_name, (key, item))
+            now = time.time()
+            con.execute(self._sql["set"], (key, item, now, now))
 
     def __delitem__(self, key):
         with self.connection(True) as con:
-            cur = con.execute("delete from `%s` where key=?" %
-                              self.table_name, (key,))
+            cur = con.execute(self._sql["del"], (key,))
             if not cur.rowcount:
                 raise KeyError
 
     def __iter__(self):
+        # Keys are fetched at once, so that the table can be modified while iterating
         with self.connection() as con:
-            for row in con.execute("select key from `%s`" %
-                                   self.table_name):
-                yield row[0]
+            keys = [row[0] for row in con.execute(self._sql["iter"])]
+        return iter(keys)
 
     def __len__(self):
         with self.connection() as con:
-            return con.execute("select count(key) from `%s`" %
-                               self.table_name).fetchone()[0]
+            return con.execute(self._sql["len"]).fetchone()[0]
 
     def clear(self):
         with self.connection(True) as con:
             con.execute("drop table `%s`" % self.table_name)
-            con.execute("create table `%s` (key PRIMARY KEY, value)" %
-                        self.table_name)
+            self._create_table(con)
+        self.vacuum()
+
+    def usage(self):
+        """ Returns a list of `(key, size in bytes, last access time)` for all items
+        """
+        with self.connection() as con:
+            return con.execute(self._sql["usage"]).fetchall()
+
+    def delete_keys(self, keys):
+        """ Deletes several keys at once, ignoring missing ones
+        """
+        with self.connection(True) as con:
+            con.executemany(self._sql["del"], ((key,) for key in keys))
+
+    def delete_created_before(self, timestamp):
+        """ Deletes items saved before ``timestamp`` (in seconds since epoch), using the index
+        on the creation time. Items saved by previous versions have no creation time and are deleted too.
+        """
+        with self.connection(True) as con:
+            return con.execute(self._sql["expire"], (timestamp,)).rowcount
+
+    def vacuum(self):
+        """ Reclaims the disk space of deleted items
+        """
+        with self.connection() as con:
+            con.commit()
             con.execute("vacuum")
 
     def __str__(self):
@@ -167,3 +246,6 @@ class DbPickleDict(DbDict):
 
     def __getitem__(self, key):
         return pickle.loads(bytes(super(DbPickleDict, self).__getitem__(key)))
+
+    def peek(self, key):
+        return pickle.loads(bytes(super(DbPickleDict, self).peek(key)))
@@ -24,7 +24,7 @@ from qgis.PyQt.QtWidgets import (
     QTreeView,
 )
 
-from . import express, resources, tests, tiles, ui
+from . import cache, express, resources, tests, tiles, ui
 from .provider import Provider
 from .utils import log, tr
 
@@ -320,6 +320,12 @@ class TTPPlugin:
         )
         self.action_run_tests.setVisible(visible)
 
+        # Resize the connection pool to the amount of concurrent requests
+        cache.instance.configure_pool()
+
+        # Enforce the cache size limit
+        cache.instance.prune_in_background()
+
     def current_layer_changed(self, layer):
         self.action_rerun.setEnabled(
             layer is not None
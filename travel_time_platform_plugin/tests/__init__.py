@@ -16,12 +16,25 @@ def run_suite(stream) -> unittest.TestResult:
             "travel_time_platform_plugin.tests.tests_express_tools",
             "travel_time_platform_plugin.tests.tests_algorithms",
             "travel_time_platform_plugin.tests.tests_misc",
+            "travel_time_platform_plugin.tests.tests_cache",
+            "travel_time_platform_plugin.tests.tests_utils",
+            "travel_time_platform_plugin.tests.tests_mock_server",
         ]
     )
     runner = unittest.TextTestRunner(stream=stream, verbosity=2)
     return runner.run(suite)
 
 
+def run_benchmark_suite(stream) -> unittest.TestResult:
+    """Runs the benchmarks against the mock server (not included in `run_suite`, as they take a while)"""
+    loader = unittest.TestLoader()
+    suite = loader.loadTestsFromNames(
+        ["travel_time_platform_plugin.tests.tests_benchmarks"]
+    )
+    runner = unittest.TextTestRunner(stream=stream, verbosity=2)
+    return runner.run(suite)
+
+
 def system_info():
     return "\n".join(
         [
@@ -1,8 +1,9 @@
 import os
 import os.path
+import shutil
 from datetime import datetime
 from pathlib import Path
-from tempfile import gettempdir
+from tempfile import gettempdir, mkdtemp
 
 import pytz
 from qgis.core import (
@@ -18,13 +19,14 @@ from qgis.core import (
     QgsVectorLayer,
 )
 from qgis.gui import QgsMapMouseEvent
-from qgis.PyQt.QtCore import QEvent, QPoint, Qt
+from qgis.PyQt.QtCore import QEvent, QPoint, QSettings, Qt
 from qgis.PyQt.QtGui import QPixmap
 from qgis.testing import unittest
 from qgis.utils import iface, plugins
 
-from .. import auth
+from .. import auth, cache, utils
 from ..main import TTPPlugin
+from .mock_server import MockServer
 
 # Set to true to save artifacts and add some delay for visual inspection
 SHOW_OUTPUT = False
@@ -112,14 +114,27 @@ class TestCaseBase(unittest.TestCase):
         pixmap.save(str(artifacts_dir))
 
     def _make_layer(
-        self, wkt_geoms, layer_type="point?crs=epsg:4326", name="untitled"
+        self,
+        wkt_geoms,
+        layer_type="point?crs=epsg:4326",
+        name="untitled",
+        attributes=None,
     ) -> QgsVectorLayer:
-        """Helper that adds a styled vector layer with the given geometries to the project and returns it"""
+        """Helper that adds a styled vector layer with the given geometries to the project and returns it
+
+        Fields can be declared in the layer type (e.g. `point?crs=epsg:4326&field=name:string(255,0)`),
+        attributes then gives the values of each feature. Geometries may be None (e.g. for `NoGeometry`).
+        """
         vl = QgsVectorLayer(layer_type, name, "memory")
-        for wkt_geom in wkt_geoms:
-            feat = QgsFeature()
-            feat.setGeometry(QgsGeometry.fromWkt(wkt_geom))
-            vl.dataProvider().addFeature(feat)
+        features = []
+        for i, wkt_geom in enumerate(wkt_geoms):
+            feat = QgsFeature(vl.fields())
+            if wkt_geom is not None:
+                feat.setGeometry(QgsGeometry.fromWkt(wkt_geom))
+            if attributes is not None:
+                feat.setAttributes(attributes[i])
+            features.append(feat)
+        vl.dataProvider().addFeatures(features)
         QgsProject.instance().addMapLayer(vl)
         return vl
 
@@ -151,3 +166,59 @@ class TestCaseBase(unittest.TestCase):
         return datetime.now().replace(
             hour=12, minute=30, second=0, microsecond=0, tzinfo=pytz.utc
         )
+
+
+class MockServerTestCaseBase(TestCaseBase):
+    """Runs the algorithms against the mock server, with a temporary cache
+
+    The user's settings and cache are restored once the tests of the class are done."""
+
+    # Settings overridden while the tests run (the endpoint is set to the mock server)
+    OVERRIDDEN_SETTINGS = {
+        "traveltime_platform/throttling_enabled": False,
+    }
+    # Arguments of the mock server
+    MOCK_SERVER_KWARGS = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockServer(**cls.MOCK_SERVER_KWARGS).start()
+
+        settings = QSettings()
+        overridden = {
+            **cls.OVERRIDDEN_SETTINGS,
+            "traveltime_platform/custom_endpoint": cls.server.url,
+        }
+        cls.previous_settings = {key: settings.value(key) for key in overridden}
+        for key, value in overridden.items():
+            settings.setValue(key, value)
+
+        cls.cache_directory = mkdtemp()
+        cls.previous_cache = cache.instance
+        cache.instance = cache.Cache(os.path.join(cls.cache_directory, "cache.sqlite"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cache.instance = cls.previous_cache
+        shutil.rmtree(cls.cache_directory, ignore_errors=True)
+
+        settings = QSettings()
+        for key, value in cls.previous_settings.items():
+            if value is None:
+                settings.remove(key)
+            else:
+                settings.setValue(key, value)
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        # The mock server doesn't check credentials, but they must be set
+        if TEST_MODE != "DESKTOP" and not os.environ.get("API_APP_ID"):
+            auth.set_app_id_and_api_key("mock", "mock")
+        cache.instance.clear()
+        self.server.reset_stats()
+
+    def tearDown(self):
+        # Errors from the mock server must not slow down the next tests
+        utils.rate_controller.reset()
+        super().tearDown()
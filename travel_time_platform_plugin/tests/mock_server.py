@@ -0,0 +1,328 @@
+"""
+A local stand-in for the TravelTime API, to run tests and benchmarks offline.
+
+It answers `/v4/time-map`, `/v4/time-filter`, `/v4/routes` and `/v4/geocoding/*` with fake (but well formed)
+results. Latency, payload size and errors can be configured. Point the plugin to it by setting the
+`traveltime_platform/custom_endpoint` setting to `MockServer.url`.
+
+It only depends on the standard library, so it can also be started on its own:
+
+    python mock_server.py --port 8000 --latency 0.2 --error-rate 0.1
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Degrees per second of travel time, to size the fake isochrones
+SPEED = 0.00002
+
+
+class MockServer:
+    """Serves fake API responses from a background thread
+
+    - latency: seconds to wait before answering each request
+    - shape_vertices: vertices of each isochrone ring (to scale the time-map payloads)
+    - error_rate: probability (0 to 1) to answer with `error_status` instead
+    - retry_after: value of the Retry-After header sent with errors (None to omit it)
+    - failing_searches: ids of searches making their request fail with 422 (as invalid searches do)
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        shape_vertices=32,
+        error_rate=0,
+        error_status=429,
+        retry_after=1,
+        failing_searches=(),
+        seed=None,
+    ):
+        self.latency = latency
+        self.shape_vertices = shape_vertices
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.failing_searches = set(failing_searches)
+        self.random = random.Random(seed)
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests_count = 0
+            self.searches_count = 0
+            self.errors_count = 0
+            self.bytes_sent = 0
+            self.first_request = None
+            self.last_response = None
+
+    def respond(self, path, query, data):
+        """Returns the status, headers and body answering a request"""
+        with self.lock:
+            self.requests_count += 1
+            if isinstance(data, dict):
+                self.searches_count += len(searches(data))
+            if self.first_request is None:
+                self.first_request = time.monotonic()
+            fail = self.random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fail:
+            with self.lock:
+                self.errors_count += 1
+            headers = {}
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+            return self.error_status, headers, error(self.error_status)
+
+        handler = ENDPOINTS.get(path)
+        if handler is None:
+            return 404, {}, error(404)
+        if isinstance(data, dict):
+            failing = [
+                search["id"]
+                for search in searches(data)
+                if search.get("id") in self.failing_searches
+            ]
+            if failing:
+                return 422, {}, error(422, f"Invalid searches: {failing}")
+        try:
+            return 200, {}, handler(self, query, data)
+        except (KeyError, TypeError, ValueError) as e:
+            return 422, {}, error(422, f"Invalid request: {e!r}")
+
+    def record_response(self, size):
+        with self.lock:
+            self.bytes_sent += size
+            self.last_response = time.monotonic()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # The body must be consumed (the plugin sends `null`), or it would be read as the next request
+        self.read_body()
+        self.handle_request(None)
+
+    def do_POST(self):
+        self.handle_request(json.loads(self.read_body() or "null"))
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def handle_request(self, data):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        status, headers, body = self.server.mock.respond(url.path, query, data)
+
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.mock.record_response(len(payload))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def error(status, description="Mocked error"):
+    return {
+        "http_status": status,
+        "error_code": 0,
+        "description": description,
+        "documentation_link": "https://docs.traveltime.com/api/reference/error-codes",
+        "additional_info": {},
+    }
+
+
+def searches(data):
+    return data.get("departure_searches", []) + data.get("arrival_searches", [])
+
+
+def time_map(mock, query, data):
+    results = []
+    for search in searches(data):
+        lat, lng = search["coords"]["lat"], search["coords"]["lng"]
+        radius = search["travel_time"] * SPEED
+        ring = [
+            (
+                lng + radius * math.cos(2 * math.pi * i / mock.shape_vertices),
+                lat + radius * math.sin(2 * math.pi * i / mock.shape_vertices),
+            )
+            for i in range(mock.shape_vertices)
+        ]
+        ring.append(ring[0])
+        coords = ", ".join(f"{x} {y}" for x, y in ring)
+        results.append(
+            {
+                "search_id": search["id"],
+                "shape": f"MULTIPOLYGON((({coords})))",
+                "properties": {"is_only_walking": False},
+            }
+        )
+    return {"results": results}
+
+
+def matrix(mock, query, data):
+    """Answers time-filter and routes requests, where each location is reachable from each search"""
+    locations = {location["id"]: location["coords"] for location in data["locations"]}
+    results = []
+    for search in searches(data):
+        origin = locations[
+            search.get("departure_location_id", search.get("arrival_location_id"))
+        ]
+        reachable = []
+        for location_id in search.get(
+            "arrival_location_ids", search.get("departure_location_ids", [])
+        ):
+            target = locations[location_id]
+            distance = math.hypot(
+                target["lat"] - origin["lat"], target["lng"] - origin["lng"]
+            )
+            travel_time = round(distance / SPEED)
+            properties = {
+                "travel_time": travel_time,
+                "distance": round(distance * 111000),
+                "distance_breakdown": [],
+                "fares": {"breakdown": [], "tickets_total": []},
+            }
+            if "route" in search.get("properties", []):
+                properties["route"] = {
+                    "departure_time": "2000-01-01T12:00:00Z",
+                    "arrival_time": "2000-01-01T12:00:00Z",
+                    "parts": [
+                        {
+                            "id": 0,
+                            "type": "basic",
+                            "mode": "walk",
+                            "directions": "Walk to the destination",
+                            "distance": properties["distance"],
+                            "travel_time": travel_time,
+                            "coords": [origin, target],
+                        }
+                    ],
+                }
+            reachable.append(
+                {
+                    "id": location_id,
+                    "properties": [
+                        {
+                            prop: properties[prop]
+                            for prop in search.get("properties", [])
+                            if prop in properties
+                        }
+                    ],
+                }
+            )
+        results.append(
+            {"search_id": search["id"], "locations": reachable, "unreachable": []}
+        )
+    return {"results": results}
+
+
+def geocoding_feature(lat, lng, name):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lng, lat]},
+        "properties": {
+            "name": name,
+            "label": name,
+            "score": 1.0,
+            "country": "Mockland",
+            "country_code": "MCK",
+        },
+    }
+
+
+def geocoding_search(mock, query, data):
+    # Coordinates are derived from the query, so that identical queries give identical results
+    digest = hashlib.sha256(query["query"].encode("utf-8")).digest()
+    lat = 51.5 + (digest[0] - 128) / 1280
+    lng = -0.1 + (digest[1] - 128) / 1280
+    return {
+        "type": "FeatureCollection",
+        "features": [geocoding_feature(lat, lng, query["query"])],
+    }
+
+
+def geocoding_reverse(mock, query, data):
+    lat, lng = float(query["lat"]), float(query["lng"])
+    return {
+        "type": "FeatureCollection",
+        "features": [geocoding_feature(lat, lng, f"{lat}, {lng}")],
+    }
+
+
+ENDPOINTS = {
+    "/v4/time-map": time_map,
+    "/v4/time-filter": matrix,
+    "/v4/routes": matrix,
+    "/v4/geocoding/search": geocoding_search,
+    "/v4/geocoding/reverse": geocoding_reverse,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--shape-vertices", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=429)
+    args = parser.parse_args()
+
+    server = MockServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        shape_vertices=args.shape_vertices,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    print(f"Mock API listening on {server.url}")
+    server.httpd.serve_forever()
@@ -2,8 +2,19 @@ import itertools
 import json
 
 import processing
-from qgis.core import QgsFeature, QgsProcessingUtils, QgsProject
-
+from qgis.core import (
+    Qgis,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsProcessingUtils,
+    QgsProject,
+    QgsVectorLayer,
+)
+from qgis.testing import unittest
+
+from ..algorithms.advanced import TimeMapAlgorithm
 from ..algorithms.simple import TRANSPORTATION_TYPES, TimeMapSimpleAlgorithm
 from ..constants import TTP_VERSION
 from ..utils import timezones
@@ -48,6 +59,10 @@ class AlgorithmsBasicTest(TestCaseBase):
             f"{output_layer.metadata().keywords('TTP_PARAMS')[0]}\n\n\nIS DIFFERNT FROM\n\n\n{parameters}",
         )
 
+        # Assert TTP_PROFILE metadata
+        profile = json.loads(output_layer.metadata().keywords("TTP_PROFILE")[0])
+        self.assertIn("processing", [phase["phase"] for phase in profile])
+
         # Assert TTP_VERSION metadata
         self.assertEquals(
             output_layer.metadata().keywords("TTP_VERSION")[0],
@@ -275,3 +290,47 @@ class AlgorithmsFeaturesTest(TestCaseBase):
                 ft_advanced.geometry().asWkt(),
                 f"Simple and advanced algorithm did not yield same geometries for {subcase_name}",
             )
+
+
+class ConstantExpressionsTest(unittest.TestCase):
+    """Testing the detection of expressions that are evaluated once for all features"""
+
+    def setUp(self):
+        self.algorithm = TimeMapAlgorithm()
+        layer = QgsVectorLayer(
+            "point?crs=epsg:4326&field=name:string(255,0)", "points", "memory"
+        )
+        self.context = QgsExpressionContext(
+            [
+                QgsExpressionContextUtils.globalScope(),
+                QgsExpressionContextUtils.layerScope(layer),
+            ]
+        )
+        self.context.setFields(layer.fields())
+
+    def _is_constant(self, expression):
+        expression = QgsExpression(expression)
+        expression.prepare(self.context)
+        return self.algorithm.is_constant_expr(expression)
+
+    def test_literals(self):
+        self.assertTrue(self._is_constant("900"))
+        self.assertTrue(self._is_constant("'walking'"))
+
+    def test_static_expressions(self):
+        # QGIS only finds static values when preparing expressions since 3.20
+        static_supported = Qgis.QGIS_VERSION_INT >= 32000
+        self.assertEqual(self._is_constant("15 * 60"), static_supported)
+        self.assertEqual(self._is_constant("upper('walking')"), static_supported)
+
+    def test_feature_dependent_expressions(self):
+        self.assertFalse(self._is_constant('"name"'))
+        self.assertFalse(self._is_constant("\"name\" || '_search'"))
+        self.assertFalse(self._is_constant("$id"))
+        self.assertFalse(self._is_constant("@row_number"))
+        self.assertFalse(self._is_constant("x($geometry)"))
+        self.assertFalse(self._is_constant("rand(1, 10)"))
+
+    def test_invalid_expressions(self):
+        self.assertFalse(self._is_constant(""))
+        self.assertFalse(self._is_constant("1 +"))
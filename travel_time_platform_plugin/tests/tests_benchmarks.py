@@ -0,0 +1,159 @@
+import json
+import os
+import random
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import gettempdir
+
+import processing
+
+from .. import cache
+from .base import MockServerTestCaseBase
+
+# Amounts of features to benchmark, can be overriden with a comma separated list (e.g. `10,1000`)
+SIZES = [
+    int(size)
+    for size in os.environ.get("TTP_BENCHMARK_SIZES", "10,1000,100000").split(",")
+]
+# Simulated latency of the API (in seconds)
+LATENCY = float(os.environ.get("TTP_BENCHMARK_LATENCY", "0.05"))
+
+
+class BenchmarkTest(MockServerTestCaseBase):
+    """Measures the throughput of the algorithms against the mock server
+
+    These are not part of the default test suite (see `run_benchmark_suite`). They use a temporary
+    cache, cleared before each run, so that all searches are actually requested."""
+
+    MOCK_SERVER_KWARGS = {"latency": LATENCY, "seed": 0}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+
+        lines = [
+            f"{'algorithm':<30}{'features':>10}{'requests':>10}{'req/s':>10}{'prep (s)':>10}{'output (s)':>12}{'total (s)':>11}{'peak (MB)':>11}"
+        ]
+        for r in cls.results:
+            lines.append(
+                f"{r['algorithm']:<30}{r['features']:>10}{r['requests']:>10}{r['requests_per_second']:>10.1f}"
+                f"{r['preparation']:>10.2f}{r['output']:>12.2f}{r['duration']:>11.2f}{r['peak_memory'] / 1024 ** 2:>11.1f}"
+            )
+        print("\n".join(lines))
+
+        report = Path(gettempdir()) / "ttp_tests" / "benchmarks.json"
+        os.makedirs(report.parent, exist_ok=True)
+        report.write_text(json.dumps(cls.results, indent=2))
+
+    def _random_points(self, count):
+        """Returns points (as WKT) randomly spread around London"""
+        return [
+            f"POINT({random.uniform(-0.3, 0.1)} {random.uniform(51.4, 51.6)})"
+            for _ in range(count)
+        ]
+
+    def _benchmark(self, algorithm_name, size, parameters):
+        """Runs the algorithm and records its timings"""
+        cache.instance.clear()
+        self.server.reset_stats()
+
+        tracemalloc.start()
+        started = time.monotonic()
+        processing.run(algorithm_name, {**parameters, "OUTPUT": "memory:"})
+        ended = time.monotonic()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Preparation is what happens before the first request, output what happens after the last response
+        first_request = self.server.first_request or ended
+        last_response = self.server.last_response or ended
+        network = last_response - first_request
+        self.results.append(
+            {
+                "algorithm": algorithm_name,
+                "features": size,
+                "requests": self.server.requests_count,
+                "errors": self.server.errors_count,
+                "bytes": self.server.bytes_sent,
+                "requests_per_second": self.server.requests_count / network
+                if network
+                else 0,
+                "preparation": first_request - started,
+                "output": ended - last_response,
+                "duration": ended - started,
+                "peak_memory": peak_memory,
+            }
+        )
+        self.assertGreater(self.server.requests_count, 0)
+
+    def test_benchmark_time_map(self):
+        for size in SIZES:
+            self._benchmark(
+                "ttp_v4:time_map",
+                size,
+                {
+                    "INPUT_DEPARTURE_SEARCHES": self._make_layer(
+                        self._random_points(size)
+                    ),
+                    "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                    "INPUT_DEPARTURE_TRAVEL_TIME": "900",
+                },
+            )
+
+    def test_benchmark_time_filter(self):
+        for size in SIZES:
+            self._benchmark(
+                "ttp_v4:time_filter",
+                size,
+                {
+                    "INPUT_DEPARTURE_SEARCHES": self._make_layer(
+                        self._random_points(1)
+                    ),
+                    "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                    "INPUT_DEPARTURE_TRAVEL_TIME": "900",
+                    "INPUT_LOCATIONS": self._make_layer(self._random_points(size)),
+                },
+            )
+
+    def test_benchmark_routes(self):
+        for size in SIZES:
+            self._benchmark(
+                "ttp_v4:routes",
+                size,
+                {
+                    "INPUT_DEPARTURE_SEARCHES": self._make_layer(
+                        self._random_points(1)
+                    ),
+                    "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                    "INPUT_LOCATIONS": self._make_layer(self._random_points(size)),
+                },
+            )
+
+    def test_benchmark_geocoding(self):
+        for size in SIZES:
+            self._benchmark(
+                "ttp_v4:geocoding",
+                size,
+                {
+                    "INPUT_DATA": self._make_layer(
+                        [None] * size,
+                        "NoGeometry?crs=EPSG:4326&field=place:string(255,0)",
+                        attributes=[[f"Place {i}"] for i in range(size)],
+                    ),
+                    "INPUT_QUERY_FIELD": '"place"',
+                },
+            )
+
+    def test_benchmark_reverse_geocoding(self):
+        for size in SIZES:
+            self._benchmark(
+                "ttp_v4:reverse_geocoding",
+                size,
+                {"INPUT_DATA": self._make_layer(self._random_points(size))},
+            )
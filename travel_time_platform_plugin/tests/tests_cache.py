@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import requests
+from qgis.PyQt.QtCore import QSettings
+from qgis.testing import unittest
+
+from .. import cache
+from ..libraries import requests_cache
+from .mock_server import MockServer
+
+
+class CompressedDbCacheTest(unittest.TestCase):
+    """Testing the slim records of the requests cache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = cache.CompressedDbCache(os.path.join(self.directory, "cache"))
+        self.session = requests_cache.core.CachedSession(
+            backend=self.backend,
+            expire_after=cache.EXPIRE_AFTER,
+            allowable_methods=("GET", "POST"),
+        )
+        self.server = MockServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.session.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _send(self):
+        request = self.session.prepare_request(
+            requests.Request(
+                "GET",
+                self.server.url + "/v4/geocoding/search",
+                params={"query": "London"},
+            )
+        )
+        return request, self.session.send(request)
+
+    def test_round_trip(self):
+        _, response = self._send()
+        _, cached = self._send()
+
+        self.assertFalse(response.from_cache)
+        self.assertTrue(cached.from_cache)
+        self.assertEqual(self.server.requests_count, 1)
+        self.assertEqual(cached.status_code, response.status_code)
+        self.assertEqual(cached.url, response.url)
+        self.assertEqual(cached.headers["Content-Type"], "application/json")
+        self.assertEqual(cached.json(), response.json())
+
+    def test_expired_entry(self):
+        request, _ = self._send()
+        key = self.backend.create_key(request)
+        self.backend.add_key_mapping("alias", key)
+
+        # Make the entry older than the expiry
+        record, _ = self.backend.responses[key]
+        self.backend.responses[key] = (
+            record,
+            datetime.utcnow() - cache.EXPIRE_AFTER - timedelta(minutes=1),
+        )
+
+        # The expired entry is deleted (with its aliases) and requested again
+        _, response = self._send()
+        self.assertFalse(response.from_cache)
+        self.assertEqual(self.server.requests_count, 2)
+        self.assertNotIn("alias", self.backend.keys_map)
+
+        # Deleting through an alias removes the response too
+        self.backend.add_key_mapping("alias", key)
+        self.backend.delete("alias")
+        self.assertNotIn(key, self.backend.responses)
+        self.assertNotIn("alias", self.backend.keys_map)
+
+
+class CachePruningTest(unittest.TestCase):
+    """Testing the eviction of least recently used entries"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.Cache(os.path.join(self.directory, "cache.sqlite"))
+        self.previous_max_size = QSettings().value("traveltime_platform/cache_max_size")
+        QSettings().setValue("traveltime_platform/cache_max_size", 1)
+
+    def tearDown(self):
+        if self.previous_max_size is None:
+            QSettings().remove("traveltime_platform/cache_max_size")
+        else:
+            QSettings().setValue(
+                "traveltime_platform/cache_max_size", self.previous_max_size
+            )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_prune(self):
+        backend = self.cache.cached_requests.cache
+        backend.responses["response"] = ({"content": b""}, datetime.utcnow())
+        backend.add_key_mapping("alias", "response")
+        # 1.6MB of searches (incompressible), saved after the response
+        for i in range(4):
+            self.cache.searches[f"search_{i}"] = (
+                os.urandom(400 * 1024),
+                datetime.utcnow(),
+            )
+
+        self.cache.prune()
+
+        # The least recently used entries were evicted until the cache fits 1MB
+        self.assertNotIn("response", backend.responses)
+        self.assertNotIn("alias", backend.keys_map)
+        self.assertEqual(list(self.cache.searches), ["search_2", "search_3"])
+
+
+class SearchesCacheTest(unittest.TestCase):
+    """Testing the cache of individual searches"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.Cache(os.path.join(self.directory, "cache.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        result = {"shape": "MULTIPOLYGON(((0 0, 1 0, 1 1, 0 0)))", "properties": {}}
+        key = self.cache.search_key("/v4/time-map", {"id": "a", "travel_time": 900})
+        # The id isn't part of the key
+        self.assertEqual(
+            key, self.cache.search_key("/v4/time-map", {"id": "b", "travel_time": 900})
+        )
+        self.assertFalse(self.cache.has_search(key))
+        self.assertEqual(self.cache.get_search(key), (None, 0))
+
+        self.cache.save_search(key, result)
+
+        self.assertTrue(self.cache.has_search(key))
+        self.assertEqual(self.cache.get_search(key), (result, len(json.dumps(result))))
+
+    def test_record(self):
+        self.cache.record(False, 1000, 10)
+        self.cache.record(True, 100)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 10))
+        self.assertEqual(
+            (self.cache.bytes_from_cache, self.cache.bytes_from_api), (100, 1000)
+        )
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Testing the connection pool shared by the sessions"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous_concurrent_requests = QSettings().value(
+            "traveltime_platform/concurrent_requests"
+        )
+        QSettings().setValue("traveltime_platform/concurrent_requests", 4)
+        self.cache = cache.Cache(os.path.join(self.directory, "cache.sqlite"))
+
+    def tearDown(self):
+        if self.previous_concurrent_requests is None:
+            QSettings().remove("traveltime_platform/concurrent_requests")
+        else:
+            QSettings().setValue(
+                "traveltime_platform/concurrent_requests",
+                self.previous_concurrent_requests,
+            )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_reconfigure(self):
+        adapter = self.cache.session.get_adapter("http://")
+        self.assertIs(adapter, self.cache.cached_requests.get_adapter("http://"))
+        with MockServer() as server:
+            self.cache.session.get(server.url + "/v4/geocoding/search?query=London")
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+
+        # Unchanged settings keep the pool
+        self.cache.configure_pool()
+        self.assertIs(self.cache.session.get_adapter("http://"), adapter)
+
+        # The previous pool is closed when it's replaced
+        QSettings().setValue("traveltime_platform/concurrent_requests", 8)
+        self.cache.configure_pool()
+        self.assertIsNot(self.cache.session.get_adapter("http://"), adapter)
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
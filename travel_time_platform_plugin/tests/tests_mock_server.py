@@ -0,0 +1,199 @@
+import processing
+from qgis.core import QgsProcessingException
+
+from ..algorithms.advanced import TimeMapAlgorithm
+from .base import MockServerTestCaseBase
+
+
+class RobustModeTest(MockServerTestCaseBase):
+    """Testing that robust mode isolates the failing searches"""
+
+    def _run_time_map(self, robust_mode):
+        return processing.run(
+            "ttp_v4:time_map",
+            {
+                "INPUT_DEPARTURE_SEARCHES": self._make_layer(
+                    [f"POINT({-0.1 + i / 100} 51.5)" for i in range(4)],
+                    "point?crs=epsg:4326&field=name:string(255,0)",
+                    attributes=[["a"], ["b"], ["c"], ["d"]],
+                ),
+                "INPUT_DEPARTURE_ID": '"name"',
+                "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                "INPUT_DEPARTURE_TRAVEL_TIME": "900",
+                "INPUT_ROBUST_MODE": robust_mode,
+                "OUTPUT": "memory:",
+            },
+        )
+
+    def test_failing_search_is_skipped(self):
+        self.server.failing_searches = {"c"}
+        try:
+            results = self._run_time_map(robust_mode=True)
+        finally:
+            self.server.failing_searches = set()
+
+        ids = sorted(f["id"] for f in results["OUTPUT"].getFeatures())
+        self.assertEqual(ids, ["a", "b", "d"])
+        # The whole request, then [a, b] and [c, d], then [c] and [d]
+        self.assertEqual(self.server.requests_count, 5)
+
+    def test_failing_search_fails_without_robust_mode(self):
+        self.server.failing_searches = {"c"}
+        try:
+            with self.assertRaises(QgsProcessingException):
+                self._run_time_map(robust_mode=False)
+        finally:
+            self.server.failing_searches = set()
+        self.assertEqual(self.server.requests_count, 1)
+
+
+class GeocodingDeduplicationTest(MockServerTestCaseBase):
+    """Testing that features with the same query are only geocoded once"""
+
+    def test_geocoding(self):
+        places = ["London", "  london ", "Paris", "London"]
+        vl = self._make_layer(
+            [None] * len(places),
+            "NoGeometry?crs=EPSG:4326&field=place:string(255,0)",
+            attributes=[[place] for place in places],
+        )
+
+        results = processing.run(
+            "ttp_v4:geocoding",
+            {"INPUT_DATA": vl, "INPUT_QUERY_FIELD": '"place"', "OUTPUT": "memory:"},
+        )
+
+        self.assertEqual(self.server.requests_count, 2)
+        names = [f["geocoded_name"] for f in results["OUTPUT"].getFeatures()]
+        self.assertEqual(names, ["London", "London", "Paris", "London"])
+
+    def test_reverse_geocoding(self):
+        # The first two points are the same once rounded to 5 decimals
+        vl = self._make_layer(
+            [
+                "POINT(-0.1000012 51.5000012)",
+                "POINT(-0.0999996 51.4999991)",
+                "POINT(0 51.5)",
+            ]
+        )
+
+        results = processing.run(
+            "ttp_v4:reverse_geocoding", {"INPUT_DATA": vl, "OUTPUT": "memory:"}
+        )
+
+        self.assertEqual(self.server.requests_count, 2)
+        # The query is sent with the coordinates of the first point (not the rounded ones)
+        points = [f.geometry().asPoint() for f in results["OUTPUT"].getFeatures()]
+        for point in points[:2]:
+            self.assertAlmostEqual(point.x(), -0.1000012, places=9)
+            self.assertAlmostEqual(point.y(), 51.5000012, places=9)
+
+
+class SearchesCacheTest(MockServerTestCaseBase):
+    """Testing that time-map searches are cached individually"""
+
+    def _run_time_map(self, wkt_geoms):
+        return processing.run(
+            "ttp_v4:time_map",
+            {
+                "INPUT_DEPARTURE_SEARCHES": self._make_layer(wkt_geoms),
+                "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                "INPUT_DEPARTURE_TRAVEL_TIME": "900",
+                "OUTPUT": "memory:",
+            },
+        )
+
+    def test_only_new_searches_are_requested(self):
+        points = ["POINT(-0.1 51.5)", "POINT(-0.11 51.5)", "POINT(-0.12 51.5)"]
+        self._run_time_map(points)
+        self.assertEqual(self.server.searches_count, 3)
+
+        self.server.reset_stats()
+        results = self._run_time_map(points + ["POINT(-0.13 51.5)"])
+
+        # Only the new search was requested, the others were read from the cache
+        self.assertEqual(self.server.requests_count, 1)
+        self.assertEqual(self.server.searches_count, 1)
+        self.assertEqual(results["OUTPUT"].featureCount(), 4)
+
+
+class RetriesTest(MockServerTestCaseBase):
+    """Testing that errors asking to slow down are retried"""
+
+    # With this seed, 3 requests fail before 10 succeed, so no query exceeds the retries
+    MOCK_SERVER_KWARGS = {"error_rate": 0.3, "retry_after": 0, "seed": 2}
+
+    def test_errors_are_retried(self):
+        results = processing.run(
+            "ttp_v4:reverse_geocoding",
+            {
+                "INPUT_DATA": self._make_layer(
+                    [f"POINT({-0.1 + i / 100} 51.5)" for i in range(10)]
+                ),
+                "OUTPUT": "memory:",
+            },
+        )
+        self.assertEqual(self.server.errors_count, 3)
+        self.assertEqual(self.server.requests_count, 13)
+        self.assertEqual(results["OUTPUT"].featureCount(), 10)
+
+
+class TimeMapAggregationTest(MockServerTestCaseBase):
+    """Testing the union and intersection of time-map shapes"""
+
+    # Isochrones of the mock server are circles of 0.018 degrees for 15 minutes
+    OVERLAPPING = ["POINT(-0.1 51.5)", "POINT(-0.11 51.5)", "POINT(-0.1 51.51)"]
+    DISJOINT = ["POINT(-0.1 51.5)", "POINT(1 51.5)", "POINT(-0.1 51.51)"]
+
+    def setUp(self):
+        super().setUp()
+        # Union shapes by chunks of 2, to test the cascaded union
+        self.previous_chunk_size = TimeMapAlgorithm.union_chunk_size
+        TimeMapAlgorithm.union_chunk_size = 2
+
+    def tearDown(self):
+        TimeMapAlgorithm.union_chunk_size = self.previous_chunk_size
+        super().tearDown()
+
+    def _aggregate(self, wkt_geoms, result_type):
+        results = processing.run(
+            "ttp_v4:time_map",
+            {
+                "INPUT_DEPARTURE_SEARCHES": self._make_layer(wkt_geoms),
+                "INPUT_DEPARTURE_TIME": self._today_at_noon().isoformat(),
+                "INPUT_DEPARTURE_TRAVEL_TIME": "900",
+                "OUTPUT_RESULT_TYPE": TimeMapAlgorithm.RESULT_TYPE.index(result_type),
+                "OUTPUT": "memory:",
+            },
+        )
+        features = list(results["OUTPUT"].getFeatures())
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["id"], result_type)
+        return features[0].geometry()
+
+    def _shape_area(self):
+        return self._aggregate(self.OVERLAPPING[:1], "UNION").area()
+
+    def test_union_overlapping(self):
+        geom = self._aggregate(self.OVERLAPPING, "UNION")
+        self.assertEqual(len(list(geom.parts())), 1)
+        self.assertGreater(geom.area(), self._shape_area())
+        self.assertLess(geom.area(), 3 * self._shape_area())
+
+    def test_union_disjoint(self):
+        geom = self._aggregate(self.DISJOINT, "UNION")
+        # The shapes of the first and third searches overlap
+        self.assertEqual(len(list(geom.parts())), 2)
+
+    def test_intersection_overlapping(self):
+        geom = self._aggregate(self.OVERLAPPING, "INTERSECTION")
+        self.assertFalse(geom.isEmpty())
+        self.assertLess(geom.area(), self._shape_area())
+
+    def test_intersection_disjoint(self):
+        # The remaining searches (in other requests) are skipped once the intersection is empty
+        geom = self._aggregate(
+            self.DISJOINT + [f"POINT(-0.1 {51.5 + i / 1000})" for i in range(30)],
+            "INTERSECTION",
+        )
+        self.assertTrue(geom.isEmpty())
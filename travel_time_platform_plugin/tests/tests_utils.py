@@ -0,0 +1,279 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from qgis.core import QgsProcessingException
+from qgis.PyQt.QtCore import QSettings
+from qgis.testing import unittest
+
+from ..utils import BatchSizer, BufferedSink, Profiler, RateController, Throttler
+
+
+class BatchSizerTest(unittest.TestCase):
+    """Testing the adaptation of the amount of searches per request"""
+
+    def test_starts_at_maximum(self):
+        self.assertEqual(BatchSizer(10).size, 10)
+
+    def test_halved_on_slow_responses(self):
+        sizer = BatchSizer(10)
+        sizer.record(10, BatchSizer.SLOW + 1, 0)
+        self.assertEqual(sizer.size, 5)
+        sizer.record(5, BatchSizer.SLOW + 1, 0)
+        self.assertEqual(sizer.size, 2)
+        sizer.record(2, BatchSizer.SLOW + 1, 0)
+        sizer.record(1, BatchSizer.SLOW + 1, 0)
+        self.assertEqual(sizer.size, 1)
+
+    def test_halved_on_large_responses(self):
+        sizer = BatchSizer(10)
+        sizer.record(10, 0, BatchSizer.LARGE + 1)
+        self.assertEqual(sizer.size, 5)
+
+    def test_halved_from_the_smaller_batch(self):
+        # A slow response to a smaller batch (e.g. the last one) halves that batch's size
+        sizer = BatchSizer(10)
+        sizer.record(4, BatchSizer.SLOW + 1, 0)
+        self.assertEqual(sizer.size, 2)
+
+    def test_doubled_up_to_maximum(self):
+        sizer = BatchSizer(10)
+        sizer.record(10, BatchSizer.SLOW + 1, 0)
+        sizer.record(5, BatchSizer.SLOW + 1, 0)
+        self.assertEqual(sizer.size, 2)
+        sizer.record(2, 0, 0)
+        self.assertEqual(sizer.size, 4)
+        sizer.record(4, 0, 0)
+        sizer.record(8, 0, 0)
+        self.assertEqual(sizer.size, 10)
+
+    def test_kept_otherwise(self):
+        sizer = BatchSizer(10)
+        sizer.record(10, BatchSizer.SLOW + 1, 0)
+        # Neither fast nor slow
+        sizer.record(5, (BatchSizer.FAST + BatchSizer.SLOW) / 2, 0)
+        self.assertEqual(sizer.size, 5)
+        # Fast, but the batch was smaller than the current size
+        sizer.record(3, 0, 0)
+        self.assertEqual(sizer.size, 5)
+
+
+class FakeSink:
+    """Records the batches of features written to it"""
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    def addFeatures(self, features, flags=None):
+        if self.fail:
+            return False
+        self.batches.append(list(features))
+        return True
+
+    def lastError(self):
+        return "disk full"
+
+
+class FakeFeedback:
+    def __init__(self):
+        self.infos = []
+
+    def pushInfo(self, info):
+        self.infos.append(info)
+
+
+class BufferedSinkTest(unittest.TestCase):
+    """Testing the writing of features in chunks"""
+
+    def setUp(self):
+        self.sink = FakeSink()
+        self.feedback = FakeFeedback()
+        self.profiler = Profiler()
+        self.buffered = BufferedSink(
+            self.sink, self.feedback, chunk_size=3, profiler=self.profiler
+        )
+
+    def test_chunks(self):
+        for i in range(7):
+            self.assertTrue(self.buffered.addFeature(i))
+        self.assertEqual(self.sink.batches, [[0, 1, 2], [3, 4, 5]])
+
+        self.buffered.finish()
+        self.assertEqual(self.sink.batches, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(self.buffered.written, 7)
+        self.assertEqual(len(self.feedback.infos), 1)
+        counts = {p["phase"]: p["count"] for p in self.profiler.summary()}
+        self.assertEqual(counts["write output"], 3)
+
+    def test_add_features(self):
+        self.assertTrue(self.buffered.addFeatures(range(4)))
+        self.assertEqual(self.sink.batches, [[0, 1, 2]])
+
+    def test_flush(self):
+        self.buffered.addFeature(0)
+        self.buffered.flush()
+        self.assertEqual(self.sink.batches, [[0]])
+        # Nothing is written when the buffer is empty
+        self.buffered.flush()
+        self.assertEqual(self.sink.batches, [[0]])
+
+    def test_write_failure(self):
+        self.sink.fail = True
+        self.buffered.addFeature(0)
+        with self.assertRaisesRegex(QgsProcessingException, "disk full"):
+            self.buffered.flush()
+
+
+class ThrottlerTest(unittest.TestCase):
+    """Testing the token bucket limiting the searches"""
+
+    OVERRIDDEN_SETTINGS = {
+        "traveltime_platform/throttling_enabled": True,
+        "traveltime_platform/throttling_max_searches_count": 10,
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "throttle.sqlite")
+        self.throttler = Throttler(self.path)
+
+        settings = QSettings()
+        self.previous_settings = {
+            key: settings.value(key) for key in self.OVERRIDDEN_SETTINGS
+        }
+        for key, value in self.OVERRIDDEN_SETTINGS.items():
+            settings.setValue(key, value)
+
+    def tearDown(self):
+        settings = QSettings()
+        for key, value in self.previous_settings.items():
+            if value is None:
+                settings.remove(key)
+            else:
+                settings.setValue(key, value)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _elapse(self, seconds):
+        """Moves the last update of the bucket back in time"""
+        self.throttler.connection().execute(
+            "update bucket set updated = updated - ?", (seconds,)
+        )
+
+    def test_reserve(self):
+        self.assertAlmostEqual(self.throttler.reserve(4, 10), 6, places=2)
+        self.assertAlmostEqual(self.throttler.reserve(10, 10), -4, places=2)
+
+    def test_refill(self):
+        self.throttler.reserve(10, 10)
+        # Half of the bucket is refilled in half the duration
+        self._elapse(Throttler.DURATION / 2)
+        self.assertAlmostEqual(self.throttler.reserve(0, 10), 5, places=2)
+        # It never holds more than its capacity
+        self._elapse(Throttler.DURATION * 2)
+        self.assertAlmostEqual(self.throttler.reserve(0, 10), 10, places=2)
+
+    def test_shared(self):
+        # Throttlers using the same database (e.g. in other processes) share the bucket
+        Throttler(self.path).reserve(4, 10)
+        self.assertAlmostEqual(self.throttler.reserve(0, 10), 6, places=2)
+
+    def test_throttle_query(self):
+        throttle, recent = self.throttler.throttle_query(6)
+        self.assertEqual(throttle, 0)
+        self.assertEqual(recent, 6)
+
+        # Searches over the budget wait until the bucket would be refilled
+        throttle, recent = self.throttler.throttle_query(6)
+        self.assertAlmostEqual(throttle, 2 * Throttler.DURATION / 10, places=0)
+        self.assertEqual(recent, 12)
+
+    def test_throttle_query_disabled(self):
+        QSettings().setValue("traveltime_platform/throttling_enabled", False)
+        self.assertEqual(self.throttler.throttle_query(100), (0, -1))
+
+
+class RateControllerTest(unittest.TestCase):
+    """Testing the adaptation of the rate of requests (AIMD) and the retries backoff"""
+
+    def setUp(self):
+        self.controller = RateController()
+
+    def _send(self, count):
+        for _ in range(count):
+            self.controller.reserve()
+
+    def test_not_limited_initially(self):
+        self._send(100)
+        self.assertIsNone(self.controller.rate)
+        self.assertEqual(self.controller.reserve(), 0)
+
+    def test_slow_down(self):
+        self._send(40)
+        self.controller.slow_down()
+        # Half the rate observed over the window
+        self.assertAlmostEqual(self.controller.rate, 40 / RateController.WINDOW / 2)
+        # Concurrent errors only slow down once
+        self.controller.slow_down()
+        self.assertAlmostEqual(self.controller.rate, 40 / RateController.WINDOW / 2)
+        # Later errors halve the rate again
+        self.controller.last_decrease -= 1
+        self.controller.slow_down()
+        self.assertAlmostEqual(self.controller.rate, 40 / RateController.WINDOW / 4)
+
+    def test_requests_are_spaced(self):
+        self._send(40)
+        self.controller.slow_down()
+        self.controller.reserve()
+        self.assertAlmostEqual(self.controller.reserve(), 1 / self.controller.rate, 1)
+
+    def test_min_rate(self):
+        self.controller.slow_down()
+        self.assertEqual(self.controller.rate, RateController.MIN_RATE)
+
+    def test_speed_up(self):
+        self._send(40)
+        self.controller.slow_down()
+        rate = self.controller.rate
+        self.controller.speed_up()
+        self.assertAlmostEqual(self.controller.rate, rate + RateController.INCREASE)
+        # The rate isn't limited anymore once well above the rate actually reached
+        for _ in range(200):
+            self.controller.speed_up()
+        self.assertIsNone(self.controller.rate)
+
+    def test_reset(self):
+        self.controller.slow_down()
+        self.controller.reset()
+        self.assertIsNone(self.controller.rate)
+        self.assertEqual(self.controller.reserve(), 0)
+
+    def test_retry_delay_backoff(self):
+        for attempt in range(3):
+            backoff = RateController.BACKOFF * 2**attempt
+            delay = self.controller.retry_delay(attempt)
+            self.assertGreaterEqual(delay, backoff / 2)
+            self.assertLessEqual(delay, backoff)
+        self.assertLessEqual(
+            self.controller.retry_delay(20), RateController.MAX_BACKOFF
+        )
+
+    def test_retry_delay_retry_after_seconds(self):
+        self.assertGreaterEqual(self.controller.retry_delay(0, "30"), 30)
+        # The backoff applies if it's longer
+        self.assertLessEqual(
+            self.controller.retry_delay(0, "0"), RateController.BACKOFF
+        )
+
+    def test_retry_delay_retry_after_date(self):
+        retry_date = datetime.now(timezone.utc) + timedelta(seconds=30)
+        delay = self.controller.retry_delay(0, format_datetime(retry_date, usegmt=True))
+        self.assertGreater(delay, 28)
+        self.assertLessEqual(delay, 30)
+
+    def test_retry_delay_invalid_retry_after(self):
+        self.assertLessEqual(
+            self.controller.retry_delay(0, "soon"), RateController.BACKOFF
+        )
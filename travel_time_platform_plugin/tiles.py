@@ -1,8 +1,7 @@
-import requests
 from qgis.core import Qgis, QgsSettings
 from qgis.PyQt.QtCore import QSettings
 
-from . import auth
+from . import auth, cache
 from .utils import tr
 
 
@@ -26,7 +25,7 @@ class TilesManager:
     def add_tiles_to_browser(self):
         # We test access to tiles with API
         test_url = self._get_url(list(self.tiles.keys())[0])
-        response = requests.get(test_url.format(z=12, x=2048, y=1361))
+        response = cache.instance.session.get(test_url.format(z=12, x=2048, y=1361))
         has_tiles = response.ok
 
         if not has_tiles:
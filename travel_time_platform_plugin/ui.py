@@ -5,7 +5,7 @@ from processing.gui.AlgorithmDialog import AlgorithmDialog
 from processing.gui.ParametersPanel import ParametersPanel
 from qgis.gui import QgsAbstractProcessingParameterWidgetWrapper as Wrapper
 from qgis.PyQt import uic
-from qgis.PyQt.QtCore import QDate, QDateTime, QSettings, Qt, QTime, QUrl
+from qgis.PyQt.QtCore import QDate, QDateTime, QSettings, Qt, QTime, QTimer, QUrl
 from qgis.PyQt.QtWidgets import QDateTimeEdit, QDialog, QWidget
 
 try:
@@ -39,6 +39,11 @@ class ConfigDialog(QDialog):
         self.apiKeyHelpLabel.setOpenExternalLinks(True)
         self.throttleCallsCheckBox.toggled.connect(self.throttleCallsSpinBox.setEnabled)
 
+        # Keep the cache statistics up to date while the dialog is shown
+        self.cacheTimer = QTimer(self)
+        self.cacheTimer.setInterval(1000)
+        self.cacheTimer.timeout.connect(self.refresh_cache_label)
+
     def showEvent(self, *args, **kwargs):
         super().showEvent(*args, **kwargs)
 
@@ -73,8 +78,25 @@ class ConfigDialog(QDialog):
         self.throttleCallsSpinBox.setValue(
             s.value("traveltime_platform/throttling_max_searches_count", 300, type=int)
         )
+        # concurrency
+        self.concurrentRequestsSpinBox.setValue(
+            s.value("traveltime_platform/concurrent_requests", 4, type=int)
+        )
+        # output
+        self.sinkChunkSizeSpinBox.setValue(
+            s.value("traveltime_platform/sink_chunk_size", 1000, type=int)
+        )
+        # cache size
+        self.cacheMaxSizeSpinBox.setValue(
+            s.value("traveltime_platform/cache_max_size", 1024, type=int)
+        )
         # refresh current cache
         self.refresh_cache_label()
+        self.cacheTimer.start()
+
+    def hideEvent(self, *args, **kwargs):
+        self.cacheTimer.stop()
+        super().hideEvent(*args, **kwargs)
 
     def get_key(self):
         webbrowser.open("https://docs.traveltime.com/qgis/sign-up/")
@@ -103,7 +125,15 @@ class ConfigDialog(QDialog):
 
     def refresh_cache_label(self):
         self.cacheLabel.setText(
-            tr("Current cache size : {}").format(cache.instance.size())
+            tr(
+                "Current cache size : {} ({} hits, {} misses, {} read from cache and {} from the API since QGIS started)"
+            ).format(
+                cache.instance.size(),
+                cache.instance.hits,
+                cache.instance.misses,
+                cache.format_size(cache.instance.bytes_from_cache),
+                cache.format_size(cache.instance.bytes_from_api),
+            )
         )
 
     def accept(self, *args, **kwargs):
@@ -133,6 +163,19 @@ class ConfigDialog(QDialog):
             "traveltime_platform/throttling_max_searches_count",
             self.throttleCallsSpinBox.value(),
         )
+        # concurrency
+        s.setValue(
+            "traveltime_platform/concurrent_requests",
+            self.concurrentRequestsSpinBox.value(),
+        )
+        # output
+        s.setValue(
+            "traveltime_platform/sink_chunk_size", self.sinkChunkSizeSpinBox.value()
+        )
+        # cache size
+        s.setValue(
+            "traveltime_platform/cache_max_size", self.cacheMaxSizeSpinBox.value()
+        )
         # endpoint
         s.setValue("traveltime_platform/custom_endpoint", self.endpointLineEdit.text())
 
@@ -1,14 +1,23 @@
+import collections
+import contextlib
+import os
+import random
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 from qgis.core import (
     Qgis,
     QgsCoordinateReferenceSystem,
-    QgsFeature,
-    QgsGeometry,
+    QgsFeatureSink,
+    QgsFeedback,
     QgsMessageLog,
+    QgsProcessingException,
 )
-from qgis.PyQt.QtCore import QCoreApplication, QSettings, QTimeZone
+from qgis.PyQt.QtCore import QCoreApplication, QSettings, QStandardPaths, Qt, QTimeZone
 
 EPSG4326 = QgsCoordinateReferenceSystem("EPSG:4326")
 
@@ -34,24 +43,41 @@ def now_iso():
     )
 
 
-def clone_feature(request, source_layer, output_fields=None):
-    """Returns a feature cloned from the source layer
+def flatten_marking_last(groups):
+    """Yields (item, is_last) for each item of each group, is_last being True for the last item of its group"""
+    for group in groups:
+        iterator = iter(group)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        for following in iterator:
+            yield item, False
+            item = following
+        yield item, True
 
-    request : QgsFeatureRequest of the source feature
-    source_layer : the layer to clone from
-    output_fields : QgsFields to initialize the clone (if none, source_layers.fields() will be used)
+
+def ordered_map(func, iterable, max_workers=None):
+    """Yields func(item) for each item, computed in a thread pool but yielded in order
+
+    The iterable is consumed lazily from the calling thread, keeping a bounded amount of items in flight.
     """
-    if output_fields is None:
-        output_fields = source_layer.fields()
-    new_feature = QgsFeature(output_fields)
-    for old_feature in source_layer.getFeatures(request):
-        # Return the first one
-        break
-    new_feature.setGeometry(QgsGeometry(old_feature.geometry()))
-    # Clone all attributes
-    for i in range(len(source_layer.fields())):
-        new_feature.setAttribute(i, old_feature.attribute(i))
-    return new_feature
+    max_workers = max_workers or os.cpu_count() or 1
+    iterator = iter(iterable)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                for item in iterator:
+                    pending.append(executor.submit(func, item))
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 def log(msg, tag="TravelTime", level=Qgis.Info):
@@ -62,11 +88,248 @@ def tr(string):
     return QCoreApplication.translate("@default", string)
 
 
+class SerializedFeedback:
+    """Wraps a feedback so that it can safely be used from several threads
+
+    The feedback's log is not thread-safe, so calls are serialized with a lock. The workers can also be
+    stopped without canceling the algorithm (see stop)."""
+
+    def __init__(self, feedback):
+        self.feedback = feedback
+        self.lock = threading.RLock()
+        # Canceled along with the wrapped feedback, or by stop()
+        self.cancellation = QgsFeedback()
+        feedback.canceled.connect(self.cancellation.cancel, Qt.DirectConnection)
+        if feedback.isCanceled():
+            self.cancellation.cancel()
+
+    def isCanceled(self):
+        return self.cancellation.isCanceled()
+
+    @property
+    def canceled(self):
+        return self.cancellation.canceled
+
+    def stop(self):
+        """Cancels the workers (e.g. when their results aren't needed anymore), waking up those that are waiting
+
+        Their messages are dropped from then on, as they would report the cancellation as an error.
+        """
+        self.cancellation.cancel()
+
+    def __getattr__(self, name):
+        attr = getattr(self.feedback, name)
+        if not callable(attr):
+            return attr
+
+        def serialized(*args, **kwargs):
+            with self.lock:
+                if self.cancellation.isCanceled() and not self.feedback.isCanceled():
+                    return None
+                return attr(*args, **kwargs)
+
+        return serialized
+
+
+class BufferedSink:
+    """Wraps a feature sink so that features are written in chunks
+
+    Each call to the sink can be a round trip to the data provider (e.g. for GeoPackage or PostGIS), so
+    features are buffered and written with addFeatures. Call flush() to write the buffered features
+    (e.g. once a slice is processed), and finish() at the end, which also reports the throughput.
+    """
+
+    def __init__(self, sink, feedback, chunk_size=None, profiler=None):
+        if chunk_size is None:
+            chunk_size = QSettings().value(
+                "traveltime_platform/sink_chunk_size", 1000, type=int
+            )
+        self.sink = sink
+        self.feedback = feedback
+        self.profiler = profiler
+        self.chunk_size = max(1, chunk_size)
+        self.buffer = []
+        self.written = 0
+        self.writing_time = 0
+
+    def addFeature(self, feature, flags=QgsFeatureSink.FastInsert):
+        self.buffer.append(feature)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return True
+
+    def addFeatures(self, features, flags=QgsFeatureSink.FastInsert):
+        for feature in features:
+            self.addFeature(feature, flags)
+        return True
+
+    def flush(self):
+        if not self.buffer:
+            return
+        started = time.monotonic()
+        if not self.sink.addFeatures(self.buffer, QgsFeatureSink.FastInsert):
+            raise QgsProcessingException(
+                tr("Could not write features to the output : {}").format(
+                    self.sink.lastError()
+                )
+            )
+        duration = time.monotonic() - started
+        if self.profiler is not None:
+            self.profiler.record("write output", duration)
+        self.writing_time += duration
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def finish(self):
+        self.flush()
+        self.feedback.pushInfo(
+            tr("Wrote {} features to the output in {:.2f}s ({:.0f} features/s)").format(
+                self.written,
+                self.writing_time,
+                self.written / self.writing_time if self.writing_time else 0,
+            )
+        )
+
+
+class Profiler:
+    """Records the wall-clock time and count of each phase of an algorithm run
+
+    Some phases (such as requests) run concurrently in several threads, so their cumulated time can
+    be more than the total duration of the run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Phase name -> [count, total, max], in order of first occurence
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name, duration):
+        with self.lock:
+            stats = self.phases.setdefault(name, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    def summary(self):
+        """Returns the statistics of each phase, as a list of dicts (to be serialized)"""
+        with self.lock:
+            return [
+                {"phase": name, "count": count, "total": total, "max": max_}
+                for name, (count, total, max_) in self.phases.items()
+            ]
+
+    def table(self):
+        """Returns the statistics of each phase, as a text table"""
+        lines = [
+            "{:<24}{:>8}{:>12}{:>12}".format("Phase", "Count", "Total (s)", "Max (s)")
+        ]
+        for stats in self.summary():
+            lines.append(
+                "{phase:<24}{count:>8}{total:>12.3f}{max:>12.3f}".format(**stats)
+            )
+        return "\n".join(lines)
+
+
+class BatchSizer:
+    """Adapts the amount of searches sent per request to the responses received so far
+
+    The size starts at the API limit. It is halved when responses are slow or large (e.g. detailed
+    isochrones), and grows back towards the limit when responses are fast and small again.
+    """
+
+    # Responses slower than this (in seconds) shrink the batches, faster ones grow them
+    SLOW = 30
+    FAST = 5
+    # Responses larger than this (in bytes) shrink the batches, smaller ones grow them
+    LARGE = 16 * 1024 * 1024
+    SMALL = 4 * 1024 * 1024
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.size = maximum
+        self.lock = threading.Lock()
+
+    def record(self, count, duration, payload_size):
+        """Records the response to a batch of `count` searches"""
+        with self.lock:
+            if duration > BatchSizer.SLOW or payload_size > BatchSizer.LARGE:
+                self.size = max(1, min(self.size, count) // 2)
+            elif (
+                duration < BatchSizer.FAST
+                and payload_size < BatchSizer.SMALL
+                and count >= self.size
+            ):
+                self.size = min(self.maximum, self.size * 2)
+
+
 class Throttler:
+    """Token bucket limiting the searches sent to the API
+
+    The bucket holds up to the configured amount of searches, and refills entirely in DURATION seconds.
+    Its state is kept in a small sqlite database, so that the budget is shared by all threads and by all
+    QGIS processes (e.g. the desktop application and qgis_process) of the user. Searches are reserved
+    atomically : when the bucket is short, the reservation still happens (the bucket goes negative) and
+    the caller must wait until it would have been refilled."""
+
     DURATION = 60
 
-    def __init__(self):
-        self.queries = []
+    def __init__(self, path=None):
+        if path is None:
+            base = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
+            os.makedirs(base, exist_ok=True)
+            path = os.path.join(base, "ttp_throttle.sqlite")
+        self.path = path
+        # Each thread keeps its own connection open, rather than opening one for each reservation
+        self._local = threading.local()
+        self.connection().execute(
+            "create table if not exists bucket (id INTEGER PRIMARY KEY CHECK (id = 0), tokens REAL, updated REAL)"
+        )
+
+    def connection(self):
+        """Returns the connection of the current thread"""
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            # Autocommit mode, transactions are started explicitly. The connection is only used by this
+            # thread, but it may be garbage collected by another one
+            con = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._local.connection = con
+        return con
+
+    def reserve(self, count, capacity):
+        """Takes `count` searches from the bucket, returning the amount of searches left (may be negative)"""
+        rate = capacity / Throttler.DURATION
+        con = self.connection()
+        try:
+            # Lock the database for writing before reading, so that reservations are atomic across processes
+            con.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = con.execute(
+                "select tokens, updated from bucket where id = 0"
+            ).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + (now - row[1]) * rate)
+            tokens -= count
+            con.execute(
+                "insert or replace into bucket (id, tokens, updated) values (0, ?, ?)",
+                (tokens, now),
+            )
+            con.execute("COMMIT")
+        except Exception:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        return tokens
 
     def throttle_query(self, new_search_count):
         """
@@ -82,33 +345,100 @@ class Throttler:
         max_searches_count = QSettings().value(
             "traveltime_platform/throttling_max_searches_count", 300, type=int
         )
+        max_searches_count = max(1, max_searches_count)
+
+        tokens = self.reserve(new_search_count, max_searches_count)
 
-        threshold = datetime.now() - timedelta(seconds=Throttler.DURATION)
+        # Searches made in the last DURATION seconds (approximately, as the bucket refills continuously)
+        recent_searches_count = round(max_searches_count - tokens)
+        if tokens < 0:
+            # Wait until the bucket is refilled enough
+            throttle = -tokens * Throttler.DURATION / max_searches_count
+            return throttle, recent_searches_count
 
-        # Prune old entries
-        self.queries = sorted([t for t in self.queries if t[0] >= threshold])
+        return 0, recent_searches_count
 
-        # Add the searches
-        self.queries.append((datetime.now(), new_search_count))
 
-        # See if we must throttle
-        recent_searches_count = sum(v[1] for v in self.queries)
-        if recent_searches_count > max_searches_count:
-            # See how long we must throttle
-            tot = 0
-            for q in self.queries:
-                tot += q[1]
-                if tot >= new_search_count:
-                    throttle = (
-                        Throttler.DURATION - (datetime.now() - q[0]).total_seconds()
-                    )
-                    break
-            else:
-                throttle = Throttler.DURATION
+class RateController:
+    """Adapts the rate of requests when the API asks to slow down, with additive increase/multiplicative decrease
 
-            return throttle, recent_searches_count
+    The rate isn't limited until the API answers with 429 or 5xx errors. It is then set to half the rate
+    observed recently, halved again on further errors, and slowly increased after each successful
+    request, until it isn't limited anymore. The controller is shared by all algorithms and threads.
+    """
 
-        return 0, recent_searches_count
+    # Duration (in seconds) over which the recent rate is observed
+    WINDOW = 10
+    # Rates in requests per second
+    MIN_RATE = 0.1
+    INCREASE = 0.05
+    # Backoff before retrying (in seconds), doubled on each attempt
+    BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Stops limiting the rate and forgets the recent requests"""
+        with self.lock:
+            self.rate = None
+            self.next_time = 0
+            self.last_decrease = 0
+            self.recent = collections.deque()
+
+    def reserve(self):
+        """Registers a request, returning how long (in seconds) to wait before sending it"""
+        with self.lock:
+            now = time.monotonic()
+            self.recent.append(now)
+            while self.recent[0] < now - RateController.WINDOW:
+                self.recent.popleft()
+            if self.rate is None:
+                return 0
+            start = max(now, self.next_time)
+            self.next_time = start + 1 / self.rate
+            return start - now
+
+    def slow_down(self):
+        """Halves the rate (once per second at most, as concurrent requests fail together)"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease < 1:
+                return
+            self.last_decrease = now
+            if self.rate is None:
+                self.rate = len(self.recent) / RateController.WINDOW
+            self.rate = max(RateController.MIN_RATE, self.rate / 2)
+
+    def speed_up(self):
+        """Slowly increases the rate after a successful request"""
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate += RateController.INCREASE
+            # Stop limiting once the limit is well above the rate that's actually reached
+            if self.rate > 2 * len(self.recent) / RateController.WINDOW + 1:
+                self.rate = None
+
+    def retry_delay(self, attempt, retry_after=None):
+        """Returns how long to wait before a retry : a jittered exponential backoff, but no less than the Retry-After header"""
+        backoff = min(RateController.MAX_BACKOFF, RateController.BACKOFF * 2**attempt)
+        delay = random.uniform(backoff / 2, backoff)
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                try:
+                    retry_date = parsedate_to_datetime(retry_after)
+                    delay = max(
+                        delay, (retry_date - datetime.now(timezone.utc)).total_seconds()
+                    )
+                except (TypeError, ValueError):
+                    pass
+        return delay
 
 
 throttler = Throttler()
+rate_controller = RateController()